@@ -0,0 +1,376 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'Benchmarks of Personal Network Storage'
+
+__author__ = 'mytpp'
+
+
+import sys
+import os
+import shutil
+import argparse
+import asyncio
+import datetime
+import json
+import platform
+import subprocess
+import tempfile
+import time
+import yaml
+
+import logging
+logging.basicConfig(level=logging.INFO)
+
+import pns
+
+
+#--------------------------------Wire Protocol---------------------------------#
+# Cost of encoding and parsing one request, in text headers and in binary
+# frames (see 'Binary Framing' in pns.py). Messages are read from a
+# StreamReader the same way 'echo_request' reads them.
+
+def sample_request():
+    cmd = ['ls', '//h2/movies/2018/some dir']
+    fields = {'N': pns.LS_PAGE, 'O': pns.make_token('avengers.mp4')}
+    return cmd, fields
+
+def encode_text(n):
+    cmd, fields = sample_request()
+    return b''.join(pns.make_header(cmd, req_id=i, fields=fields).encode('utf-8')
+                    for i in range(n))
+
+def encode_binary(n):
+    cmd, fields = sample_request()
+    return b''.join(pns.make_request_frame(cmd, req_id=i, fields=fields)
+                    for i in range(n))
+
+async def parse_text(data, n):
+    reader = asyncio.StreamReader()
+    reader.feed_data(data)
+    reader.feed_eof()
+    for _ in range(n):
+        header = pns.parse_header((await reader.readuntil(b'\n\n')).decode('utf-8'))
+        pns.split_command(header['C'])
+
+async def parse_binary(data, n):
+    reader = asyncio.StreamReader()
+    reader.feed_data(data)
+    reader.feed_eof()
+    for _ in range(n):
+        header, _ = await pns.read_request_frame(reader)
+        pns.split_command(header['C'])
+
+def bench_wire(n):
+    for name, encode, parse in (('text', encode_text, parse_text),
+                                ('binary', encode_binary, parse_binary)):
+        start = time.perf_counter()
+        data = encode(n)
+        encoded = time.perf_counter()
+        asyncio.run(parse(data, n))
+        parsed = time.perf_counter()
+        logging.info(f'{name:6}: {len(data) / n:.0f} bytes/message, '
+                     f'encode {(encoded - start) / n * 1e6:.2f}us, '
+                     f'parse {(parsed - encoded) / n * 1e6:.2f}us per message')
+
+
+#--------------------------------Round Trips-----------------------------------#
+# Pipelined 'ca' requests over one multiplexed connection to a running daemon.
+
+async def round_trips(addr, n, window):
+    connection = pns.PeerConnection(addr)
+    semaphore = asyncio.Semaphore(window)
+    async def request():
+        async with semaphore:
+            await connection.request('ca')
+    await connection.request('ca') # connect first
+    start = time.perf_counter()
+    await asyncio.gather(*[request() for _ in range(n)])
+    elapsed = time.perf_counter() - start
+    await connection.close()
+    return elapsed
+
+def bench_round_trips(addr, n, window):
+    for binary in (False, True):
+        pns.config['binary'] = binary
+        elapsed = asyncio.run(round_trips(addr, n, window))
+        logging.info(f'{"binary" if binary else "text":6}: {n / elapsed:.0f} requests/s '
+                     f'with {window} in flight')
+
+
+#----------------------------------Metadata------------------------------------#
+# 'ls' of a page of one entry on 'paths' in turn, each sent to the tracker
+# holding it, to see how metadata throughput grows with sharded trackers.
+
+async def list_paths(paths, n, window):
+    semaphore = asyncio.Semaphore(window)
+    async def request(path):
+        async with semaphore:
+            err_msg, _ = await pns.shard_request(path, ['ls', path], fields={'N': 1})
+            if pns.check_error(err_msg):
+                raise RuntimeError(f'Fail to list {path!r}')
+    await pns.get_routes()
+    start = time.perf_counter()
+    await asyncio.gather(*[request(paths[i % len(paths)]) for i in range(n)])
+    elapsed = time.perf_counter() - start
+    await pns.close_connections()
+    return elapsed
+
+def bench_ls(paths, n, window):
+    elapsed = asyncio.run(list_paths(paths, n, window))
+    logging.info(f'ls: {n / elapsed:.0f} requests/s over {len(pns.routes["shards"])} '
+                 f'trackers with {window} in flight')
+
+
+#---------------------------------Local Suite----------------------------------#
+# Start a tracker and 'agents' daemons of pns.py on loopback, with generated
+# configs and roots in a temporary dir, and measure:
+#   registration of the synthetic tree of each agent when it starts,
+#   'ln' of a tree, 'ls' latency of dirs of several sizes,
+#   'cp' throughput of small and large files between agents,
+#   CPU time tracker spends on heartbeats.
+# This process acts as the shell of agent 1. Results are written as json.
+
+PNS = os.path.join(os.path.split(os.path.realpath(__file__))[0], 'pns.py')
+SUITE_PORT = 61000
+LS_SIZES = [10, 100, 1000, 10000]
+LS_TIMES = 50
+SMALL_FILES = 500
+SMALL_SIZE = 16 * 1024
+LARGE_SIZE = 64 * 1024 * 1024
+HEARTBEAT_WINDOW = 10
+
+# write 'count' files of 'size' bytes in 'fanout' dirs under 'root',
+# return the number of paths made
+def make_tree(root, count, size=0, fanout=1):
+    content = b'x' * size
+    for i in range(fanout):
+        os.makedirs(os.path.join(root, f'd{i}'), exist_ok=True)
+    for i in range(count):
+        with open(os.path.join(root, f'd{i % fanout}', f'f{i}'), 'wb') as f:
+            f.write(content)
+    return count + fanout + 1
+
+def make_large(path, size):
+    with open(path, 'wb') as f:
+        for _ in range(size // (1024 * 1024)):
+            f.write(os.urandom(1024 * 1024))
+
+def write_config(work, name, port, is_tracker):
+    root = os.path.join(work, name)
+    os.makedirs(root, exist_ok=True)
+    config = {
+        'name': name, 'port': port, 'root': root + '/', 'secret': 'bench',
+        'tracker': f'127.0.0.1:{SUITE_PORT}', 'istracker': is_tracker,
+        'db': os.path.join(work, name + '.sqlite3'), 'watch': 'off',
+        'resolve_cache': ''
+    }
+    path = os.path.join(work, name + '.yml')
+    with open(path, 'w', encoding='utf-8') as f:
+        yaml.safe_dump(config, f)
+    return path
+
+async def wait_port(port, process, timeout=600):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f'Daemon on port {port} exited')
+        try:
+            _, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.close()
+            return
+        except OSError:
+            await asyncio.sleep(0.1)
+    raise RuntimeError(f'Daemon on port {port} is not serving')
+
+def start_daemon(work, name):
+    log = open(os.path.join(work, name + '.log'), 'w')
+    return subprocess.Popen([sys.executable, PNS, '-m', 'daemon', 
+                             '-c', os.path.join(work, name + '.yml')],
+                            stdout=log, stderr=subprocess.STDOUT, cwd=work)
+
+# CPU seconds used by a process so far, None if unknown
+def cpu_time(pid):
+    try: # in nanoseconds, rather than clock ticks of '/proc/pid/stat'
+        with open(f'/proc/{pid}/schedstat') as f:
+            return int(f.read().split()[0]) / 1e9
+    except OSError:
+        return None
+
+# the registration an agent logged when it started
+def registration_of(work, name):
+    with open(os.path.join(work, name + '.log')) as f:
+        for line in f:
+            if 'Register ' in line and ' paths under ' in line:
+                count = int(line.split('Register ', 1)[1].split(' ', 1)[0])
+                seconds = float(line.split(' in ', 1)[1].split('s ', 1)[0])
+                return {'records': count, 'seconds': seconds, 
+                        'records_per_s': count / max(seconds, 1e-6)}
+
+def percentile(values, ratio):
+    values = sorted(values)
+    return values[min(int(len(values) * ratio), len(values) - 1)]
+
+async def bench_suite(work, agents, large_size):
+    results = {}
+    names = [f'a{i}' for i in range(1, agents + 1)]
+    write_config(work, 't0', SUITE_PORT, True)
+    for i, name in enumerate(names, 1):
+        write_config(work, name, SUITE_PORT + i, False)
+
+    # synthetic trees, made before agents start so that they register them
+    logging.info('Generating trees...')
+    first = os.path.join(work, names[0])
+    for size in LS_SIZES:
+        make_tree(os.path.join(first, f'ls{size}'), size)
+    make_tree(os.path.join(first, 'small'), SMALL_FILES, SMALL_SIZE, fanout=10)
+    make_large(os.path.join(first, 'large.bin'), large_size)
+    # another content, so that pulling it isn't a local copy of 'large.bin'
+    make_large(os.path.join(work, names[-1], 'pull.bin'), large_size)
+    link_tree = os.path.join(work, 'link')
+    link_count = make_tree(link_tree, 10000, fanout=100)
+
+    processes = []
+    try:
+        tracker = start_daemon(work, 't0')
+        processes.append(tracker)
+        await wait_port(SUITE_PORT, tracker)
+        for i, name in enumerate(names, 1):
+            processes.append(start_daemon(work, name))
+            await wait_port(SUITE_PORT + i, processes[-1])
+        results['registration'] = registration_of(work, names[0])
+
+        pns.parse_config(os.path.join(work, names[0] + '.yml'))
+        logging.getLogger().setLevel(logging.WARNING)
+
+        start = time.perf_counter()
+        await pns.ln(link_tree, '/link')
+        elapsed = time.perf_counter() - start
+        results['ln'] = {'records': link_count, 'seconds': elapsed,
+                         'records_per_s': link_count / elapsed}
+
+        results['ls'] = {}
+        for size in LS_SIZES:
+            path = f'//{names[0]}/ls{size}/d0'
+            latencies = []
+            for _ in range(LS_TIMES):
+                start = time.perf_counter()
+                err_msg, _ = await pns.shard_request(path, ['ls', path])
+                latencies.append((time.perf_counter() - start) * 1000)
+                if pns.check_error(err_msg):
+                    raise RuntimeError(f'Fail to list {path!r}: {err_msg}')
+            results['ls'][str(size)] = {
+                'p50_ms': percentile(latencies, 0.5),
+                'p90_ms': percentile(latencies, 0.9),
+                'max_ms': max(latencies)}
+
+        results['cp'] = {}
+        other = names[-1]
+        copies = [('small_push', f'//{names[0]}/small', f'//{other}/small', 
+                   SMALL_FILES, SMALL_FILES * SMALL_SIZE),
+                  ('large_push', f'//{names[0]}/large.bin', f'//{other}/large.bin', 
+                   1, large_size),
+                  ('large_pull', f'//{other}/pull.bin', f'//{names[0]}/pulled.bin', 
+                   1, large_size)]
+        for name, src, dst, files, size in copies:
+            if other == names[0]: # copies are between two agents
+                break
+            start = time.perf_counter()
+            await pns.cp(src, dst)
+            elapsed = time.perf_counter() - start
+            if not os.path.exists(os.path.join(work, dst.split('/', 3)[2], 
+                                               dst.split('/', 3)[3])):
+                raise RuntimeError(f'Fail to copy {src!r} to {dst!r}')
+            results['cp'][name] = {'files': files, 'bytes': size, 'seconds': elapsed,
+                                   'mb_per_s': size / elapsed / 1024 / 1024}
+        await pns.close_connections()
+
+        # tracker is left with nothing but heartbeats
+        before = cpu_time(tracker.pid)
+        await asyncio.sleep(HEARTBEAT_WINDOW)
+        after = cpu_time(tracker.pid)
+        heartbeats = agents * HEARTBEAT_WINDOW
+        results['heartbeat'] = {
+            'agents': agents, 'seconds': HEARTBEAT_WINDOW,
+            'cpu_seconds': None if before is None else after - before,
+            'cpu_us_per_heartbeat': None if before is None 
+                                    else (after - before) / heartbeats * 1e6}
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+    return results
+
+def git_version():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], 
+                              cwd=os.path.dirname(PNS), capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_suite(agents, output, large_size, keep):
+    work = tempfile.mkdtemp(prefix='pns-bench-')
+    logging.info(f'Benchmark in {work!r}')
+    try:
+        results = asyncio.run(bench_suite(work, agents, large_size))
+    finally:
+        if not keep:
+            shutil.rmtree(work, ignore_errors=True)
+    report = {
+        'version': git_version(),
+        'time': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'results': results
+    }
+    data = json.dumps(report, indent=2)
+    if output:
+        with open(output, 'w', encoding='utf-8') as f:
+            f.write(data + '\n')
+    else:
+        print(data)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='PNS benchmarks')
+    parser.add_argument('-c', '--config',
+                        help='config file, whose secret is used to sign requests')
+    parser.add_argument('-n', '--number', type=int, default=100000,
+                        help='number of messages')
+    parser.add_argument('-a', '--addr',
+                        help="'ip:port' of a running daemon to send requests to")
+    parser.add_argument('-w', '--window', type=int, default=64,
+                        help='number of requests in flight')
+    parser.add_argument('-l', '--ls', nargs='+', metavar='PATH',
+                        help='paths to list through the trackers holding them')
+    parser.add_argument('-s', '--suite', action='store_true',
+                        help='run a tracker and agents on loopback and benchmark them')
+    parser.add_argument('-N', '--agents', type=int, default=2,
+                        help='number of agents of the suite')
+    parser.add_argument('--large', type=int, default=LARGE_SIZE // 1024 // 1024,
+                        help='size of the large file of the suite in MB')
+    parser.add_argument('-o', '--output',
+                        help='json file of the results of the suite, stdout by default')
+    parser.add_argument('--keep', action='store_true',
+                        help='keep the roots, configs and logs of the suite')
+    args = parser.parse_args()
+
+    if args.suite:
+        run_suite(args.agents, args.output, args.large * 1024 * 1024, args.keep)
+        return
+    if not args.config:
+        parser.error('a config file is required unless running the suite')
+    pns.parse_config(args.config)
+
+    if args.ls:
+        bench_ls(args.ls, args.number, args.window)
+        return
+    bench_wire(args.number)
+    if args.addr:
+        bench_round_trips(args.addr, args.number, args.window)
+
+
+if __name__ == '__main__':
+    main()
@@ -10,14 +10,28 @@ import sys
 import os
 import shutil
 import argparse
+import shlex
 import yaml
 import json
+import io
+import tarfile
 import asyncio
+import concurrent.futures
+import contextlib
+import contextvars
+import inspect
+import zlib
+import lzma
 import aiosqlite3
 import hashlib
+import itertools
+import bisect
 import datetime
 import time
 import socket
+import struct
+import ctypes
+import ctypes.util
 
 import logging
 logging.basicConfig(level=logging.INFO)
@@ -30,9 +44,52 @@ signal.signal(signal.SIGINT, signal.SIG_DFL)
 config = None # to be read from *.yaml
 metaDB = None # meta database used only in tracker
 
-# used by tracker to record living daemons in the pns
-# map hostname to its timestamp
+# used by tracker to record daemons in the pns, map hostname to a dict like
+# {'seen': timestamp of its last heartbeat, 'state': 'alive', 'suspect' or 
+# 'offline', 'generation': when it started, 'addr': ip and port}
 daemons = {}
+# 'ip:port' of offline daemons, whose paths are hidden rather than deleted
+offline_addrs = set()
+# Living hosts, map hostname to its 'ip:port'. Tracker increases its version
+# whenever a host joins or leaves, and other daemons keep a copy of it.
+members = {}
+members_version = 0
+
+# version of meta database schema, see 'migrate_db'
+SCHEMA_VERSION = 2
+
+# number of records in each bulk registration request,
+# and how many of these requests can be sent without waiting
+BULK_CHUNK = 5000
+BULK_WINDOW = 4
+# number of rows inserted in each transaction when tracker scans its own root
+SCAN_BATCH = 50000
+# files larger than RANGE_SIZE are copied in ranges of this size over
+# TRANSFER_STREAMS connections, a broken connection is retried RANGE_RETRIES times
+RANGE_SIZE = 16 * 1024 * 1024
+TRANSFER_STREAMS = 4
+RANGE_RETRIES = 3
+# number of entries in each page of 'ls'
+LS_PAGE = 1000
+# seconds to wait for the response to a request over a multiplexed connection
+REQUEST_TIMEOUT = 60
+# a daemon missing heartbeats for SUSPECT_TIMEOUT seconds is suspect, and 
+# offline after OFFLINE_TIMEOUT seconds
+SUSPECT_TIMEOUT = 3
+OFFLINE_TIMEOUT = 60
+# seconds a shell may use what tracker tells about a path without asking again
+LEASE = 60
+# number of commands run at a time by a shell reading them from a file
+SHELL_JOBS = 1
+# tracker commits the changes of concurrent requests together, waiting at most
+# COMMIT_WINDOW seconds for more of them, or until COMMIT_GROUP are waiting
+COMMIT_WINDOW = 0.002
+COMMIT_GROUP = 256
+# number of read-only connections to meta database, which serve 'ls', 'hs'
+# and existence checks in their own threads besides the one writing
+DB_READERS = 4
+# number of processes serving tracker's port, see 'Tracker Workers'
+WORKERS = 1
 
 
 def parse_config(file_name):
@@ -42,7 +99,7 @@ def parse_config(file_name):
     global config 
     with open(yaml_path, 'r', encoding='utf-8') as f:
         content = f.read()
-    config = yaml.load(content)
+    config = yaml.safe_load(content)
     config['root'] = config['root'].rstrip('/')
     config['port'] = str(config['port'])
     tracker_addr = config['tracker'].split(':')
@@ -51,6 +108,9 @@ def parse_config(file_name):
     # this_ip = socket.gethostbyname(socket.gethostname())
     this_ip = '127.0.0.1'
     config['ip'] = this_ip
+    # yaml reads 'on' and 'off' as booleans
+    watch = config.get('watch', 'off')
+    config['watch'] = {True: 'auto', False: 'off'}.get(watch, watch)
 
     logging.info('Load config successfully')
     logging.debug(config)
@@ -68,19 +128,38 @@ def parse_header(header_str):
         header[key] = value
     return header
 
-# construct a request header
-def make_header(cmd, length=0, is_heartbeat=False):
+# the 'A' field of command 'cmd'
+def authorize(cmd):
     sha1 = hashlib.sha1()
     sha1.update(config['secret'].encode('utf-8'))
     sha1.update(cmd.encode('utf-8'))
+    return sha1.hexdigest()
+
+# words of the 'C' field, which are divided by '\0' in binary frames
+def split_command(cmd):
+    return cmd.split('\0') if '\0' in cmd else cmd.split(' ')
+
+# construct a request header
+# 'cmd' is a string, or a list of its words, which are divided by '\0'
+# instead of ' ' if any of them holds a space, see 'split_command'
+# 'req_id' is set when the request is sent over a multiplexed connection
+# 'fields' are extra fields of the request, like {'R': offset}
+def make_header(cmd, length=0, is_heartbeat=False, req_id=None, fields=None, 
+                version='V1'):
+    if not isinstance(cmd, str):
+        cmd = ('\0' if any(' ' in word for word in cmd) else ' ').join(cmd)
     if is_heartbeat:
         header  = 'V: ' + config['name'] + ' HB' + '\n'
     else:
-        header  = 'V: ' + config['name'] + ' V1' + '\n'
-    header += 'A: ' + sha1.hexdigest() + '\n'
+        header  = 'V: ' + config['name'] + ' ' + version + '\n'
+    header += 'A: ' + authorize(cmd) + '\n'
     header += 'C: ' + cmd + '\n'
     if length > 0:
         header += 'L: ' + str(length) + '\n'
+    if req_id is not None:
+        header += 'I: ' + str(req_id) + '\n'
+    for key, value in (fields or {}).items():
+        header += key + ': ' + str(value) + '\n'
     header += '\n'
     return header
 
@@ -93,23 +172,1252 @@ async def get_error(reader, writer):
         writer.close()
         return True
 
-async def send_file(src, dst, writer, loop):
+# the same as get_error, but for an 'E: ...' line we've already received
+def check_error(err_msg):
+    logging.info(err_msg)
+    return err_msg.split(' ', 2)[1] != '200'
+
+async def send_file(src, dst, writer, loop, file_hash=None, codec=None):
     logging.info('Start sending file...')
     size = os.path.getsize(src)
+    codec = codec_for(src, codec)
+    fields = {'H': file_hash} if file_hash else {}
+    if codec:
+        fields['Z'] = codec
     with open(src, 'rb') as f:
         tr = writer.transport
         # 'size' and 'dst' is the reason why we need this header
-        header = make_header('cp ' + src + ' ' + dst, size)
+        header = make_header(['cp', src, dst], size, fields=fields)
         logging.debug(f'Send: {header!r}')
         writer.write(header.encode('utf-8'))
         await writer.drain()
         # send file
-        await loop.sendfile(tr, f) 
+        if codec:
+            await send_compressed(writer, lambda offset, size: read_at(f, offset, size),
+                                  size, codec)
+        else:
+            count('bytes_sent', await loop.sendfile(tr, f))
         writer.write_eof()
         await writer.drain()
     logging.info('Finish sending file.')
 
 
+#---------------------------------Binary Framing-------------------------------#
+# A multiplexed connection can carry binary frames instead of text headers.
+# A frame starts with a fixed-size header: magic b'PN', wire version, kind 
+# (request or response), request id, length of the fields and length of the
+# content. Each field is a one-byte key, a 2-byte length and its value, so
+# the words of a command are divided by '\0' and paths can hold spaces.
+# The connection is upgraded when its first request has 'V: name B1' and
+# the response frame answers with 'V: B1'; otherwise it stays in text.
+
+WIRE_NAME = 'B1'
+WIRE_VERSION = 1
+FRAME_MAGIC = b'PN'
+FRAME_REQUEST = 0
+FRAME_RESPONSE = 1
+FRAME_HEAD = struct.Struct('!2sBBIHQ')
+FIELD_HEAD = struct.Struct('!cH')
+
+def pack_fields(fields):
+    data = []
+    for key, value in fields.items():
+        value = str(value).encode('utf-8')
+        data.append(FIELD_HEAD.pack(key.encode('ascii'), len(value)))
+        data.append(value)
+    return b''.join(data)
+
+def unpack_fields(data):
+    fields = {}
+    offset = 0
+    try:
+        while offset < len(data):
+            key, length = FIELD_HEAD.unpack_from(data, offset)
+            offset += FIELD_HEAD.size
+            fields[key.decode('ascii')] = data[offset:offset + length].decode('utf-8')
+            offset += length
+    except struct.error:
+        raise ValueError('Truncated field')
+    return fields
+
+def make_frame(kind, req_id, fields, content=b''):
+    data = pack_fields(fields)
+    head = FRAME_HEAD.pack(FRAME_MAGIC, WIRE_VERSION, kind, int(req_id), 
+                           len(data), len(content))
+    return head + data + content
+
+# a request frame, whose arguments are the same as 'make_header'
+def make_request_frame(cmd, content=b'', is_heartbeat=False, req_id=0, fields=None,
+                       length=0):
+    if not isinstance(cmd, str):
+        cmd = '\0'.join(cmd)
+    version = 'HB' if is_heartbeat else WIRE_NAME
+    header = {'V': config['name'] + ' ' + version, 'A': authorize(cmd), 'C': cmd}
+    if length and not content: # eg. size of the file linked by 'ln'
+        header['L'] = length
+    header.update(fields or {})
+    return make_frame(FRAME_REQUEST, req_id, header, content)
+
+# return kind, request id, fields and content of the next frame
+async def read_frame(reader):
+    head = await reader.readexactly(FRAME_HEAD.size)
+    magic, version, kind, req_id, fields_length, length = FRAME_HEAD.unpack(head)
+    if magic != FRAME_MAGIC or version != WIRE_VERSION:
+        raise ValueError(f'Illegal frame {head!r}')
+    fields = unpack_fields(await reader.readexactly(fields_length))
+    content = await reader.readexactly(length)
+    return kind, str(req_id), fields, content
+
+# return a request frame as a header like the one of 'parse_header', and its content
+async def read_request_frame(reader):
+    kind, req_id, header, content = await read_frame(reader)
+    if kind != FRAME_REQUEST:
+        raise ValueError(f'Unexpected frame kind {kind}')
+    header['I'] = req_id
+    if content:
+        header['L'] = str(len(content))
+    return header, content
+
+
+#--------------------------Multiplexed Connections-----------------------------#
+# A request with an 'I' (request id) field turns its connection into a
+# multiplexed one: the connection is kept open and carries many concurrent
+# requests. Each response is sent back as a frame 'I: id\nL: length\n\n'
+# followed by what the handler wrote, ie. the 'E' line and the content.
+# A long response (like a 'ls' in ndjson mode) may be sent as many frames,
+# all but the last one with a field 'M: more'. Only the first one holds the
+# 'E' line.
+# Only commands in FRAME_COMMANDS can be multiplexed, cp and mv still need
+# a connection of their own to stream a file. For commands in BODY_COMMANDS,
+# 'L' is the length of the content following the request header.
+
+FRAME_COMMANDS = ('ln', 'ls', 'md', 'rm', 'rg', 'dg', 'rs', 'up', 'pt', 'hs', 'sc', 'ca',
+                  'hb', 'rt', 'mt', 'ms')
+BODY_COMMANDS = ('rg', 'dg', 'rs', 'up')
+
+# used by daemon to collect a handler's response into a frame, or a few when streaming
+# 'fields' are extra fields of a text frame, like {'V': 'B1'}
+class FrameWriter:
+    def __init__(self, writer, req_id, binary=False, fields=None):
+        self.writer = writer
+        self.req_id = req_id
+        self.binary = binary
+        self.fields = fields or {}
+        self.buffer = []
+        self.streaming = False # send what is written at each drain as a frame
+        self.started = False # whether a frame of the response is sent
+
+    def write(self, data):
+        self.buffer.append(data)
+
+    def write_eof(self):
+        pass
+
+    def close(self):
+        pass
+
+    async def drain(self):
+        if self.streaming and self.buffer:
+            await self.send(more=True)
+
+    async def flush(self):
+        await self.send(more=False)
+
+    async def send(self, more):
+        content = b''.join(self.buffer)
+        self.buffer = []
+        if self.binary:
+            fields = {'M': 'more'} if more else {}
+            if not self.started:
+                err_msg, _, content = content.partition(b'\n\n')
+                fields['E'] = err_msg.decode('utf-8').strip()[len('E: '):]
+            frame = make_frame(FRAME_RESPONSE, self.req_id, fields, content)
+        else:
+            header = f'I: {self.req_id}\nL: {len(content)}\n'
+            if more:
+                header += 'M: more\n'
+            if not self.started:
+                for key, value in self.fields.items():
+                    header += f'{key}: {value}\n'
+            frame = (header + '\n').encode('utf-8') + content
+        self.started = True
+        # write frame at once so that frames of concurrent requests don't interleave
+        self.writer.write(frame)
+        await self.writer.drain()
+
+
+# used by both sides to send requests to a peer over one long-lived connection
+class PeerConnection:
+    def __init__(self, addr):
+        self.addr = addr  # ip and port
+        self.reader = None
+        self.writer = None
+        self.receiver = None
+        self.binary = False # whether frames are binary, see 'Binary Framing'
+        self.waiters = {} # map request id to the future of its response
+        self.partial = {} # map request id to the 'E' line and frames of a long response
+        self.next_id = 0
+        self.lock = asyncio.Lock()
+
+    def is_open(self):
+        return self.writer is not None and not self.writer.is_closing()
+
+    async def connect(self):
+        if self.addr.startswith('/'): # the owner's socket, see 'Tracker Workers'
+            self.reader, self.writer = await asyncio.open_unix_connection(self.addr)
+        else:
+            ip, port = self.addr.split(':')
+            self.reader, self.writer = await asyncio.open_connection(ip, port)
+        self.binary = config.get('binary', True) and await self.upgrade()
+        self.receiver = asyncio.create_task(self.receive())
+        logging.debug(f'Connect to {self.addr!r}, binary frames: {self.binary}')
+
+    # ask the peer to switch to binary frames by a 'ca' request,
+    # a peer that doesn't know them answers as usual, without 'V'
+    async def upgrade(self):
+        header = make_header('ca', req_id='0', version=WIRE_NAME)
+        self.writer.write(header.encode('utf-8'))
+        await self.writer.drain()
+        data = await self.reader.readuntil(b'\n\n')
+        frame = parse_header(data.decode('utf-8'))
+        await self.reader.readexactly(int(frame['L']))
+        return frame.get('V') == WIRE_NAME
+
+    # dispatch response frames to the requests waiting for them
+    async def receive(self):
+        try:
+            while True:
+                if self.binary:
+                    _, req_id, header, content = await read_frame(self.reader)
+                else:
+                    data = await self.reader.readuntil(b'\n\n')
+                    header = parse_header(data.decode('utf-8'))
+                    content = await self.reader.readexactly(int(header['L']))
+                    req_id = header['I']
+                err_msg, chunks = self.partial.pop(req_id, (None, []))
+                if err_msg is None: # the first frame of the response
+                    if self.binary:
+                        err_msg = 'E: ' + header.get('E', '')
+                    else:
+                        err_msg, _, content = content.partition(b'\n\n')
+                        err_msg = err_msg.decode('utf-8').strip()
+                if req_id in self.waiters: # else the request is timed out
+                    chunks.append(content)
+                if 'M' in header:
+                    self.partial[req_id] = (err_msg, chunks)
+                    continue
+                future = self.waiters.pop(req_id, None)
+                if future and not future.done():
+                    future.set_result((err_msg, b''.join(chunks)))
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError) as e:
+            logging.warning(f'Lose connection to {self.addr!r}: {e!r}')
+        finally:
+            self.writer.close()
+            self.partial.clear()
+            for future in self.waiters.values():
+                if not future.done():
+                    future.set_exception(ConnectionError('Connection lost'))
+            self.waiters.clear()
+
+    # return the 'E' line and the content of the response
+    # 'cmd' is a string, or a list of its words, which may hold spaces
+    async def request(self, cmd, length=0, is_heartbeat=False, content=b'', fields=None):
+        async with self.lock:
+            if not self.is_open():
+                await self.connect()
+        self.next_id += 1
+        req_id = str(self.next_id)
+        future = asyncio.get_running_loop().create_future()
+        self.waiters[req_id] = future
+        if self.binary:
+            data = make_request_frame(cmd, content, is_heartbeat, req_id, fields, length)
+        else:
+            header = make_header(cmd, length or len(content), is_heartbeat, req_id, fields)
+            logging.debug(f'Send: {header!r}')
+            data = header.encode('utf-8') + content
+        self.writer.write(data)
+        await self.writer.drain()
+        try:
+            return await asyncio.wait_for(
+                future, config.get('request_timeout', REQUEST_TIMEOUT))
+        except asyncio.TimeoutError:
+            self.waiters.pop(req_id, None)
+            raise ConnectionError(f'Request {req_id} to {self.addr!r} timed out')
+
+    async def close(self):
+        if self.writer:
+            self.writer.close()
+        if self.receiver:
+            self.receiver.cancel()
+
+
+# map 'ip:port' to the PeerConnection to it
+connections = {}
+
+async def peer_request(addr, cmd, length=0, is_heartbeat=False, content=b'', fields=None):
+    if addr not in connections:
+        connections[addr] = PeerConnection(addr)
+    return await connections[addr].request(cmd, length, is_heartbeat, content, fields)
+
+async def tracker_request(cmd, length=0, is_heartbeat=False, content=b'', fields=None):
+    addr = config['tracker_ip'] + ':' + config['tracker_port']
+    return await peer_request(addr, cmd, length, is_heartbeat, content, fields)
+
+async def close_connections():
+    for connection in connections.values():
+        await connection.close()
+    connections.clear()
+
+
+#--------------------------------Sharded Trackers------------------------------#
+# With 'shards' in config, several trackers split the namespace, each with a
+# meta database of its own. 'shards' maps the name of each tracker to its
+# 'ip:port', in the same order in every tracker. A path belongs to a shard by
+# its first component: a logical path '/top/...' by 'top', and a physical path
+# '//host/...' by its host, so paths of a host stay together, and a tracker
+# keeps its own host. 'prefixes' pins top-level logical dirs to a shard by its
+# index, others are spread by crc32 of the component.
+# Daemons and shells fetch the routing table from the tracker in their config
+# by 'rt', and fetch it again if a tracker answers '421 Misdirected Request'.
+# '/', '//', a content hash and a daemon addressed by 'ip:port' are looked up
+# in every shard.
+
+routes = None # routing table like {'shards': [[name, addr]], 'prefixes': {}, 'version'}
+
+def make_routes():
+    shards = config.get('shards') or {config['name']: config['ip'] + ':' + config['port']}
+    prefixes = config.get('prefixes') or {}
+    table = {
+        'shards': [[name, str(addr)] for name, addr in shards.items()],
+        'prefixes': {'/' + prefix.strip('/'): int(index) 
+                     for prefix, index in prefixes.items()}
+    }
+    table['version'] = zlib.crc32(json.dumps(table, sort_keys=True).encode('utf-8'))
+    return table
+
+# index of the shard holding 'path', or None if every shard may hold it
+def shard_of(path):
+    shards = routes['shards']
+    if len(shards) == 1:
+        return 0
+    if path.startswith('//'):
+        host = path[2:].split('/', 1)[0]
+        if not host: # '//'
+            return None
+        for index, (name, addr) in enumerate(shards):
+            if host in (name, addr):
+                return index
+        if ':' in host: # a daemon by its address
+            return None
+        key = '//' + host
+    else:
+        top = path.strip('/').split('/', 1)[0]
+        if not top: # '/'
+            return None
+        key = '/' + top
+        if key in routes['prefixes']:
+            return routes['prefixes'][key]
+    return zlib.crc32(key.encode('utf-8')) % len(shards)
+
+# whether 'path' is held by another tracker than this one
+def misdirected(path):
+    if metaDB is None and owner_addr is None: # not a tracker
+        return False
+    index = shard_of(path)
+    return index is not None and \
+           routes['shards'][index][1] != config['ip'] + ':' + config['port']
+
+async def get_routes(refresh=False):
+    global routes
+    if routes is not None and not refresh:
+        return routes
+    if metaDB is not None: # a tracker has them in its config
+        routes = make_routes()
+        return routes
+    err_msg, data = await tracker_request('rt')
+    if err_msg.split(' ', 2)[1] == '200':
+        routes = json.loads(data)
+    else: # an older tracker, which holds the whole namespace
+        addr = config['tracker_ip'] + ':' + config['tracker_port']
+        routes = {'shards': [[None, addr]], 'prefixes': {}, 'version': 0}
+    logging.debug(f'Routing table: {routes!r}')
+    return routes
+
+# send a request about 'path' to the tracker holding it,
+# or to every tracker until one answers '200'
+async def shard_request(path, cmd, length=0, is_heartbeat=False, content=b'', fields=None):
+    for refresh in (False, True):
+        shards = (await get_routes(refresh))['shards']
+        index = shard_of(path)
+        addrs = [addr for _, addr in shards] if index is None else [shards[index][1]]
+        for addr in addrs:
+            err_msg, data = await peer_request(addr, cmd, length, is_heartbeat, 
+                                               content, fields)
+            code = err_msg.split(' ', 2)[1]
+            if code == '421': # the routing table is out of date
+                break
+            if code == '200' or addr == addrs[-1]:
+                return err_msg, data
+    return err_msg, data
+
+# send a request to every tracker, return their responses
+async def fan_out(cmd, length=0, is_heartbeat=False, content=b'', fields=None):
+    shards = (await get_routes())['shards']
+    return await asyncio.gather(*[
+        peer_request(addr, cmd, length, is_heartbeat, content, fields) 
+        for _, addr in shards])
+
+#-------------------------------------Metrics----------------------------------#
+# Request counts and latency, database time per command, bytes transferred
+# and heartbeat lag are kept in memory at the cost of a few additions each.
+# They're given as json by 'mt', and as text in Prometheus format over HTTP 
+# if 'metrics_port' is set in config, on localhost only. A request slower than
+# 'slow_request' seconds in config is logged with its database time.
+
+# upper bounds of histogram buckets, in seconds, from 100us to about 52s
+METRIC_BUCKETS = [0.0001 * 2 ** i for i in range(20)]
+# requests of other commands are counted as 'illegal'
+METRIC_COMMANDS = FRAME_COMMANDS + ('cp', 'mv')
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(METRIC_BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(METRIC_BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    # upper bound of the bucket holding the 'ratio' quantile, None if unbounded
+    def quantile(self, ratio):
+        rank = ratio * self.count
+        seen = 0
+        for bound, count in zip(METRIC_BUCKETS + [None], self.counts):
+            seen += count
+            if count and seen >= rank:
+                return bound
+        return 0.0
+
+started_at = time.time()
+counters = {}   # map (name, command) to a number, command is '' if no one
+histograms = {} # map (name, command) to a Histogram
+in_flight = {}  # map command to the number of its requests being handled
+# a list of the seconds spent in meta database by the current request
+db_time = contextvars.ContextVar('db_time', default=None)
+
+def count(name, value=1, cmd=''):
+    counters[(name, cmd)] = counters.get((name, cmd), 0) + value
+
+def observe(name, value, cmd=''):
+    histogram = histograms.get((name, cmd))
+    if histogram is None:
+        histogram = histograms[(name, cmd)] = Histogram()
+    histogram.observe(value)
+
+# meta database whose cursors count their time into 'db_time'
+class TimedConnection:
+    def __init__(self, connection):
+        self.connection = connection
+
+    async def cursor(self):
+        return TimedCursor(await self.connection.cursor())
+
+    async def commit(self):
+        await timed_db(self.connection.commit())
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+class TimedCursor:
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def __getattr__(self, name):
+        attr = getattr(self.cursor, name)
+        if not callable(attr):
+            return attr
+        def call(*args, **kwargs):
+            result = attr(*args, **kwargs)
+            return timed_db(result) if inspect.isawaitable(result) else result
+        return call
+
+async def timed_db(awaitable):
+    start = time.perf_counter()
+    try:
+        return await awaitable
+    finally:
+        spent = db_time.get()
+        if spent is not None:
+            spent[0] += time.perf_counter() - start
+
+# list of (name, labels, value)
+def metrics_gauges():
+    now = time.time()
+    gauges = [('uptime_seconds', {}, now - started_at)]
+    for cmd, number in in_flight.items():
+        gauges.append(('in_flight', {'cmd': cmd}, number))
+    if daemons: # this is tracker
+        for state in ('alive', 'suspect', 'offline'):
+            gauges.append(('hosts', {'state': state}, 
+                           sum(d['state'] == state for d in daemons.values())))
+        gauges.append(('heartbeat_silence_seconds', {}, max(
+            [now - d['seen'] for d in daemons.values() if d['state'] == 'alive'] or [0])))
+    return gauges
+
+def metrics_json():
+    def name_of(name, cmd):
+        return f'{name}.{cmd}' if cmd else name
+    return {
+        'gauges': {'.'.join([name] + list(labels.values())): value 
+                   for name, labels, value in metrics_gauges()},
+        'counters': {name_of(*key): value for key, value in counters.items()},
+        'histograms': {name_of(*key): {
+                'count': histogram.count, 'sum': histogram.sum,
+                'p50': histogram.quantile(0.5), 'p90': histogram.quantile(0.9),
+                'p99': histogram.quantile(0.99)}
+            for key, histogram in histograms.items()}
+    }
+
+def metrics_text():
+    def labels(cmd='', **extra):
+        pairs = ([f'cmd="{cmd}"'] if cmd else []) + [f'{k}="{v}"' for k, v in extra.items()]
+        return '{' + ','.join(pairs) + '}' if pairs else ''
+    lines = []
+    for name, extra, value in metrics_gauges():
+        lines.append(f'pns_{name}{labels(**extra)} {value}')
+    for (name, cmd), value in sorted(counters.items()):
+        lines.append(f'pns_{name}_total{labels(cmd)} {value}')
+    for (name, cmd), histogram in sorted(histograms.items()):
+        cumulative = 0
+        for bound, number in zip(METRIC_BUCKETS + [None], histogram.counts):
+            cumulative += number
+            le = '+Inf' if bound is None else f'{bound:g}'
+            lines.append(f'pns_{name}_bucket{labels(cmd, le=le)} {cumulative}')
+        lines.append(f'pns_{name}_sum{labels(cmd)} {histogram.sum}')
+        lines.append(f'pns_{name}_count{labels(cmd)} {histogram.count}')
+    return '\n'.join(lines) + '\n'
+
+# answer any HTTP request with metrics in text
+async def serve_metrics(reader, writer):
+    try:
+        await reader.readuntil(b'\r\n\r\n')
+        content = metrics_text().encode('utf-8')
+        writer.write(b'HTTP/1.0 200 OK\r\n'
+                     b'Content-Type: text/plain; version=0.0.4\r\n'
+                     + f'Content-Length: {len(content)}\r\n\r\n'.encode('utf-8') 
+                     + content)
+        await writer.drain()
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+#---------------------------------Content Hash---------------------------------#
+# Files are identified by their BLAKE2b hash. The sender of a file puts its
+# hash in 'H' field, the receiver checks what it gets against it, and tracker
+# records it, so that a file already in the destination host is copied there
+# locally instead of over network.
+
+HASH_BLOCK = 1024 * 1024
+HASH_CACHE = 100000 # max number of hashes remembered by 'hash_file'
+
+# map local path to ((size, mtime_ns), future of its hash)
+file_hashes = {}
+# map local path to (size, mtime_ns) of the file when its hash was sent to tracker
+registered_files = {}
+hash_worker = None # the thread hashing received files in order
+
+def new_hash():
+    return hashlib.blake2b(digest_size=32)
+
+def compute_hash(path):
+    file_hash = new_hash()
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(HASH_BLOCK)
+            if not block:
+                break
+            file_hash.update(block)
+    return file_hash.hexdigest()
+
+def get_hash_worker():
+    global hash_worker
+    if hash_worker is None:
+        hash_worker = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix='hash-worker')
+    return hash_worker
+
+# hash of local file 'path', which is computed in a thread unless it's known
+async def hash_file(path):
+    stat = os.stat(path)
+    key = (stat.st_size, stat.st_mtime_ns)
+    known = file_hashes.get(path)
+    if known is None or known[0] != key:
+        if len(file_hashes) >= HASH_CACHE:
+            file_hashes.clear()
+        loop = asyncio.get_running_loop()
+        known = (key, loop.run_in_executor(None, compute_hash, path))
+        file_hashes[path] = known
+    return await known[1]
+
+# remember the hash of a file we've just received
+def remember_hash(path, file_hash):
+    stat = os.stat(path)
+    future = asyncio.get_running_loop().create_future()
+    future.set_result(file_hash)
+    file_hashes[path] = ((stat.st_size, stat.st_mtime_ns), future)
+
+# Copy local file 'src' to 'dst' if its hash is still 'file_hash'.
+# Return False if the content has changed.
+async def copy_local(src, dst, file_hash):
+    if await hash_file(src) != file_hash:
+        return False
+    await asyncio.get_running_loop().run_in_executor(None, shutil.copyfile, src, dst)
+    remember_hash(dst, file_hash)
+    return True
+
+#---------------------------------Receive Engine-------------------------------#
+# A received file is read into preallocated buffers of RECV_BUFFER bytes, and
+# each full buffer is written to disk by os.pwrite in a writer thread while
+# the next one is being filled. A transfer uses at most RECV_BUFFERS buffers,
+# so a slow disk slows down the sender instead of blocking the event loop or
+# eating memory. Buffers are kept in 'buffer_pool' to be used by later transfers.
+
+RECV_BUFFER = 1024 * 1024
+RECV_BUFFERS = 4
+# the buffer limit of asyncio streams used to transfer files, with the default
+# 64KB limit the transport is paused before a buffer can be filled
+STREAM_LIMIT = 2 * RECV_BUFFER
+
+buffer_pool = []
+disk_writer = None # the executor writing received files, see 'get_disk_writer'
+
+def get_disk_writer():
+    global disk_writer
+    if disk_writer is None:
+        disk_writer = concurrent.futures.ThreadPoolExecutor(
+            max_workers=config.get('disk_writers', 2), 
+            thread_name_prefix='disk-writer')
+    return disk_writer
+
+# reserve 'size' bytes on disk for 'fd', so that the file is less fragmented
+# and a full disk is found before receiving anything
+def preallocate(fd, size):
+    if size <= 0:
+        return
+    if config.get('preallocate', True) and hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(fd, 0, size)
+            return
+        except OSError as e:  # not supported by the filesystem
+            logging.debug(f'posix_fallocate failed: {e!r}')
+    os.ftruncate(fd, size)
+
+# runs in writer thread
+def write_at(fd, view, offset):
+    if not hasattr(os, 'pwrite'):  # Windows
+        os.lseek(fd, offset, os.SEEK_SET)
+    while view:
+        if hasattr(os, 'pwrite'):
+            written = os.pwrite(fd, view, offset)
+        else:
+            written = os.write(fd, view)
+        view = view[written:]
+        offset += written
+
+# raise the error of writing (or hashing) a buffer if any
+def check_write(future):
+    for result in future.result():
+        if isinstance(result, Exception):
+            raise result
+
+# Receive 'length' bytes from 'reader' and write them into 'fd' from 'offset',
+# also update 'hasher' with them if it's given.
+# Raise IncompleteReadError if the connection is closed before that.
+async def receive_into(reader, fd, offset, length, hasher=None):
+    loop = asyncio.get_running_loop()
+    executor = get_disk_writer()
+    writes = set()
+    try:
+        while length > 0:
+            buffer = buffer_pool.pop() if buffer_pool else bytearray(RECV_BUFFER)
+            view = memoryview(buffer)
+            size = min(length, RECV_BUFFER)
+            filled = 0
+            while filled < size:
+                data = await reader.read(size - filled)
+                if not data:
+                    buffer_pool.append(buffer)
+                    raise asyncio.IncompleteReadError(b'', length - filled)
+                view[filled: filled + len(data)] = data
+                filled += len(data)
+            count('bytes_received', size)
+            jobs = [loop.run_in_executor(executor, write_at, fd, view[:size], offset)]
+            if hasher:  # there is only one hash worker, so buffers are hashed in order
+                jobs.append(loop.run_in_executor(
+                    get_hash_worker(), hasher.update, view[:size]))
+            future = asyncio.gather(*jobs, return_exceptions=True)
+            future.add_done_callback(lambda _, buffer=buffer: buffer_pool.append(buffer))
+            writes.add(future)
+            offset += size
+            length -= size
+            if len(writes) >= RECV_BUFFERS:
+                done, writes = await asyncio.wait(
+                    writes, return_when=asyncio.FIRST_COMPLETED)
+                for future in done:
+                    check_write(future)
+    finally:
+        # the buffers and 'fd' must not be touched until all writes finish
+        if writes:
+            await asyncio.wait(writes)
+    for future in writes:
+        check_write(future)
+    del buffer_pool[RECV_BUFFERS * 4:]
+
+# Receive a whole file of 'size' bytes from 'reader' to 'path', return its hash.
+# The data is compressed by 'codec' if it's given.
+async def receive_file(reader, path, size, codec=None):
+    flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0)
+    fd = os.open(path, flags, 0o644)
+    hasher = new_hash()
+    try:
+        preallocate(fd, size)
+        if codec:
+            await receive_compressed(reader, fd, 0, size, codec, hasher)
+        else:
+            await receive_into(reader, fd, 0, size, hasher)
+    finally:
+        os.close(fd)
+    file_hash = hasher.hexdigest()
+    remember_hash(path, file_hash)
+    return file_hash
+
+#----------------------------------Compression---------------------------------#
+# A file (or a range of it, or a pack) can be compressed on the wire. The side
+# receiving the data offers a codec in the 'Z' field of its request, like
+# 'Z: zlib', and the sender sets 'Z' in the header of the data if it does
+# compress it. When a shell pushes a file, it asks the receiver which codecs
+# it knows by a 'ca' request first.
+# 'L' is still the length of the original data, which is sent in chunks of at
+# most COMPRESS_CHUNK bytes, each following its length packed as '!I'. A chunk
+# not made smaller than COMPRESS_RATIO is sent as it is, with RAW_CHUNK set in
+# its length. After COMPRESS_MISSES such chunks in a row, only one chunk in
+# COMPRESS_PROBE is tried, so a video or an archive costs little CPU.
+
+COMPRESS_CHUNK = 1024 * 1024
+COMPRESS_AHEAD = 4 # chunks being compressed in threads while one is sent
+COMPRESS_RATIO = 0.9
+COMPRESS_MISSES = 4
+COMPRESS_PROBE = 16
+RAW_CHUNK = 0x80000000
+CHUNK_HEADER = struct.Struct('!I')
+
+# files not worth compressing at all
+COMPRESSED_SUFFIXES = ('.zip', '.gz', '.tgz', '.bz2', '.xz', '.zst', '.7z', '.rar',
+                       '.jpg', '.jpeg', '.png', '.gif', '.webp', '.mp3', '.mp4', 
+                       '.mkv', '.avi', '.mov', '.webm', '.flac', '.ogg', '.aac')
+
+# map codec to its (compress, decompressor)
+CODECS = {
+    'zlib': (zlib.compress, zlib.decompressobj),
+    # the default preset 6 is too slow to keep up with most links
+    'lzma': (lambda data: lzma.compress(data, preset=1), lzma.LZMADecompressor),
+}
+
+peer_codecs = {} # map 'ip:port' to the codecs known by it, used by shell
+warned_codecs = set() # unknown codecs in config, warned about once
+
+# the codec wanted by this shell, set by 'compress' in config or '-z'
+def wanted_codec():
+    codec = config.get('compress', 'off')
+    if codec in (False, None): # yaml reads 'off' as a boolean
+        codec = 'off'
+    if codec not in CODECS and codec != 'off' and codec not in warned_codecs:
+        warned_codecs.add(codec)
+        logging.warning(f'Unknown codec {codec!r}, copy without compression')
+    return codec if codec in CODECS else None
+
+# the codec to compress local file 'path' with, if 'codec' is negotiated
+def codec_for(path, codec):
+    if codec and path.lower().endswith(COMPRESSED_SUFFIXES):
+        return None
+    return codec
+
+# the first codec we know in 'offer', ie. a 'Z' field like 'zlib,lzma'
+def pick_codec(offer):
+    for codec in (offer or '').split(','):
+        if codec in CODECS:
+            return codec
+    return None
+
+# the codec to push files to host 'addr' with, None if it doesn't know it
+async def negotiate_codec(addr):
+    codec = wanted_codec()
+    if codec is None:
+        return None
+    if addr not in peer_codecs:
+        err_msg, data = await peer_request(addr, 'ca')
+        # an old daemon answers 'ca' with '400 Illegal Command'
+        peer_codecs[addr] = [] if check_error(err_msg) else json.loads(data)['compress']
+    return codec if codec in peer_codecs[addr] else None
+
+# runs in a thread
+def read_at(f, offset, size):
+    if hasattr(os, 'pread'):
+        return os.pread(f.fileno(), size, offset)
+    with open(f.name, 'rb') as g:  # Windows
+        g.seek(offset)
+        return g.read(size)
+
+# Send 'length' bytes got by 'read(offset, size)' (run in a thread) to 
+# 'writer', compressed by 'codec' in chunks. Return the bytes on the wire.
+async def send_compressed(writer, read, length, codec):
+    loop = asyncio.get_running_loop()
+    compress = CODECS[codec][0]
+    def make_chunk(offset, size, try_it):
+        data = read(offset, size)
+        return data, compress(data) if try_it else None
+
+    starts = range(0, length, COMPRESS_CHUNK)
+    pending = []
+    next_chunk, misses, sent = 0, 0, 0
+    started = time.monotonic()
+    while next_chunk < len(starts) or pending:
+        while next_chunk < len(starts) and len(pending) < COMPRESS_AHEAD:
+            start = starts[next_chunk]
+            try_it = misses < COMPRESS_MISSES or next_chunk % COMPRESS_PROBE == 0
+            pending.append(loop.run_in_executor(None, make_chunk, start, 
+                           min(COMPRESS_CHUNK, length - start), try_it))
+            next_chunk += 1
+        data, compressed = await pending.pop(0)
+        if compressed is not None and len(compressed) < len(data) * COMPRESS_RATIO:
+            misses = 0
+            writer.write(CHUNK_HEADER.pack(len(compressed)))
+            writer.write(compressed)
+            sent += CHUNK_HEADER.size + len(compressed)
+        else:
+            misses += compressed is not None
+            writer.write(CHUNK_HEADER.pack(RAW_CHUNK | len(data)))
+            writer.write(data)
+            sent += CHUNK_HEADER.size + len(data)
+        await writer.drain()
+    count('bytes_sent', sent)
+    elapsed = max(time.monotonic() - started, 0.001)
+    logging.info(f'Send {length} bytes as {sent} by {codec} '
+                 f'({length / max(sent, 1):.2f}x), effectively '
+                 f'{length / elapsed / 1e6:.1f}MB/s over {sent / elapsed / 1e6:.1f}MB/s')
+    return sent
+
+# Receive 'length' bytes compressed by 'codec' from 'reader', and yield them
+# in chunks. Raise ValueError if the data is illegal.
+async def decompress_stream(reader, length, codec):
+    if codec not in CODECS:
+        raise ValueError(f'Unknown codec {codec!r}')
+    decompressor = CODECS[codec][1]
+    def decompress(data):
+        chunk = decompressor()
+        try:
+            data = chunk.decompress(data, COMPRESS_CHUNK + 1)
+        except (zlib.error, lzma.LZMAError) as e:
+            raise ValueError(f'Illegal compressed chunk: {e!r}')
+        if not chunk.eof or chunk.unused_data:
+            raise ValueError('Illegal compressed chunk')
+        return data
+
+    loop = asyncio.get_running_loop()
+    while length > 0:
+        size, = CHUNK_HEADER.unpack(await reader.readexactly(CHUNK_HEADER.size))
+        is_raw = size & RAW_CHUNK
+        size &= ~RAW_CHUNK
+        if size > COMPRESS_CHUNK:
+            raise ValueError(f'Illegal chunk length {size}')
+        data = await reader.readexactly(size)
+        count('bytes_received', CHUNK_HEADER.size + size)
+        if not is_raw:
+            data = await loop.run_in_executor(None, decompress, data)
+        if not data or len(data) > min(length, COMPRESS_CHUNK):
+            raise ValueError(f'Illegal chunk length {len(data)}')
+        length -= len(data)
+        yield data
+
+# read 'length' bytes from 'reader' into memory, which are compressed by 'codec'
+# if it's given
+async def read_data(reader, length, codec=None):
+    if not codec:
+        data = await reader.readexactly(length)
+        count('bytes_received', length)
+        return data
+    return b''.join([data async for data in decompress_stream(reader, length, codec)])
+
+# the same as 'receive_into', but for data compressed by 'codec'
+async def receive_compressed(reader, fd, offset, length, codec, hasher=None):
+    loop = asyncio.get_running_loop()
+    writes = set()
+    try:
+        async for data in decompress_stream(reader, length, codec):
+            jobs = [loop.run_in_executor(get_disk_writer(), write_at, fd, data, offset)]
+            if hasher:
+                jobs.append(loop.run_in_executor(get_hash_worker(), hasher.update, data))
+            writes.add(asyncio.gather(*jobs, return_exceptions=True))
+            offset += len(data)
+            if len(writes) >= RECV_BUFFERS:
+                done, writes = await asyncio.wait(
+                    writes, return_when=asyncio.FIRST_COMPLETED)
+                for future in done:
+                    check_write(future)
+    finally:
+        if writes:
+            await asyncio.wait(writes)
+    for future in writes:
+        check_write(future)
+
+#--------------------------------Ranged Transfer-------------------------------#
+# A large file is copied in ranges. Each range is sent as a 'cp' request with
+# 'R' (offset of the range) and 'T' (size of the whole file), 'L' being the 
+# length of the range. Ranges are sent over several connections at the same
+# time, and each connection carries one range after another.
+# The receiver writes ranges into 'dst.pns-part' and appends every received
+# range to the journal 'dst.pns-journal', whose first line is like
+# {"src": src, "total": size, "hash": hash}. An interrupted copy is resumed by
+# sending only the missing ranges, which the sender learns by 'pt dst'.
+# The part file is renamed to 'dst' after all ranges are received and its
+# hash is checked.
+
+PART_SUFFIX = '.pns-part'
+JOURNAL_SUFFIX = '.pns-journal'
+
+# part files and journals are not registered to tracker
+def is_partial(path):
+    return path.endswith(PART_SUFFIX) or path.endswith(JOURNAL_SUFFIX)
+
+# merge [start, end) ranges into sorted, disjoint ones
+def merge_ranges(ranges):
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+# split what's not 'done' in [0, total) into ranges of at most 'range_size'
+def missing_ranges(done, total, range_size):
+    missing = []
+    start = 0
+    for end, next_start in merge_ranges(done) + [[total, total]]:
+        for offset in range(start, end, range_size):
+            missing.append([offset, min(offset + range_size, end)])
+        start = max(start, next_start)
+    return missing
+
+# return the journal of 'path' like 
+# {"src": src, "total": size, "hash": hash, "done": ranges},
+# or None if there isn't one
+def load_journal(path):
+    try:
+        with open(path + JOURNAL_SUFFIX, 'r', encoding='utf-8') as f:
+            lines = f.read().split('\n')
+        journal = json.loads(lines[0])
+    except (OSError, ValueError):
+        return None
+    done = []
+    for line in lines[1:-1]:  # the last line is either empty or torn by a crash
+        start, end = line.split(' ')
+        done.append([int(start), int(end)])
+    journal['done'] = merge_ranges(done)
+    return journal
+
+def start_journal(path, src, total, file_hash):
+    with open(path + PART_SUFFIX, 'wb') as f:
+        preallocate(f.fileno(), total)
+    with open(path + JOURNAL_SUFFIX, 'w', encoding='utf-8') as f:
+        f.write(json.dumps({'src': src, 'total': total, 'hash': file_hash}) + '\n')
+
+def is_journal_of(journal, src, total, file_hash):
+    return (journal is not None and journal['src'] == src and 
+            journal['total'] == total and journal.get('hash') == file_hash)
+
+# journals of the copies being received, by path, so that a journal is read
+# once per copy, and then only appended by each range, see 'receive_range'
+journals = {}
+
+# return the journal of the copy of 'src' into 'path', which is new unless
+# the one on disk (left by a broken copy) is of the same 'src'
+def open_journal(path, src, total, file_hash):
+    journal = journals.get(path)
+    if is_journal_of(journal, src, total, file_hash):
+        return journal
+    journal = load_journal(path)
+    if is_journal_of(journal, src, total, file_hash):
+        with open(path + JOURNAL_SUFFIX, 'r+b') as f:
+            data = f.read()
+            f.truncate(data.rfind(b'\n') + 1)  # drop a line torn by a crash
+    else:
+        start_journal(path, src, total, file_hash)  # this is a new copy
+        journal = {'src': src, 'total': total, 'hash': file_hash, 'done': []}
+    journals[path] = journal
+    return journal
+
+# the ranges of 'src' still needed by the receiver, whose journal is 'journal'
+def ranges_to_copy(journal, src, total, file_hash):
+    done = []
+    if is_journal_of(journal, src, total, file_hash):
+        done = journal['done']
+        logging.info(f'Resume copying {src!r}, '
+                     f'{sum(end - start for start, end in done)} bytes received')
+    return missing_ranges(done, total, config.get('range_size', RANGE_SIZE))
+
+# Receive a range of 'src' from 'reader' into the part file of 'path'.
+# Return True if it's the last range, and the part file becomes 'path'.
+# Raise ValueError if the whole file doesn't match 'file_hash'.
+async def receive_range(path, src, offset, length, total, reader, file_hash=None,
+                        codec=None):
+    journal = open_journal(path, src, total, file_hash)
+    fd = os.open(path + PART_SUFFIX, os.O_WRONLY | getattr(os, 'O_BINARY', 0))
+    try:
+        if codec:
+            await receive_compressed(reader, fd, offset, length, codec)
+        else:
+            await receive_into(reader, fd, offset, length)
+        # the range must be on disk before it's in journal
+        await asyncio.get_running_loop().run_in_executor(
+            get_disk_writer(), os.fsync, fd)
+    finally:
+        os.close(fd)
+    with open(path + JOURNAL_SUFFIX, 'ab') as f:
+        f.write(f'{offset} {offset + length}\n'.encode('utf-8'))
+    # ranges received by other streams meanwhile are in the same journal
+    journal['done'] = merge_ranges(journal['done'] + [[offset, offset + length]])
+    if journal['done'] != [[0, total]]:
+        return False
+    journals.pop(path, None)
+    # Ranges arrive out of order over several streams and copies may resume,
+    # while the hash is of the whole file in order, so the part file is read
+    # once more to hash it. It's mostly still in page cache by now.
+    loop = asyncio.get_running_loop()
+    received_hash = await loop.run_in_executor(None, compute_hash, path + PART_SUFFIX)
+    if file_hash and received_hash != file_hash:
+        os.remove(path + PART_SUFFIX)
+        os.remove(path + JOURNAL_SUFFIX)
+        raise ValueError(f'{src!r} is received with a wrong hash')
+    os.replace(path + PART_SUFFIX, path)
+    os.remove(path + JOURNAL_SUFFIX)
+    remember_hash(path, received_hash)
+    return True
+
+# send a range of local file 'src' to 'dst' as a 'cp' request
+async def send_range(src, dst, offset, length, writer, file_hash=None, codec=None):
+    total = os.path.getsize(src)
+    codec = codec_for(src, codec)
+    fields = {'R': offset, 'T': total}
+    if file_hash:
+        fields['H'] = file_hash
+    if codec:
+        fields['Z'] = codec
+    with open(src, 'rb') as f:
+        header = make_header(['cp', src, dst], length, fields=fields)
+        logging.debug(f'Send: {header!r}')
+        writer.write(header.encode('utf-8'))
+        await writer.drain()
+        if codec:
+            await send_compressed(writer, lambda start, size: read_at(f, offset + start, size),
+                                  length, codec)
+            return
+        loop = asyncio.get_running_loop()
+        count('bytes_sent', await loop.sendfile(writer.transport, f, offset, length))
+
+# Call 'transfer(reader, writer, item)' for each of 'items' (ranges of a file,
+# or packs of files) over several connections to 'addr'. An item broken by
+# a lost connection is retried on a new connection. 
+# Return True if all items are transferred.
+async def transfer_items(addr, items, transfer):
+    items = list(items)
+    ip, port = addr.split(':')
+
+    async def run_stream():
+        retries = 0
+        while items:
+            writer = None
+            try:
+                reader, writer = await asyncio.open_connection(
+                    ip, port, limit=STREAM_LIMIT)
+                while items:
+                    item = items.pop(0)
+                    try:
+                        if not await transfer(reader, writer, item):
+                            return False
+                    except (asyncio.IncompleteReadError, OSError):
+                        items.append(item)
+                        raise
+            except (asyncio.IncompleteReadError, OSError) as e:
+                retries += 1
+                if retries > RANGE_RETRIES:
+                    logging.error(f'Give up copying with {addr!r}: {e!r}')
+                    return False
+                logging.warning(f'Connection to {addr!r} is broken, retry: {e!r}')
+                await asyncio.sleep(retries)
+            finally:
+                if writer:
+                    writer.close()
+        return True
+
+    streams = min(config.get('transfer_streams', TRANSFER_STREAMS), len(items))
+    results = await asyncio.gather(*(run_stream() for _ in range(streams)))
+    return all(results)
+
+
+#---------------------------------Directory Copy-------------------------------#
+# A dir is copied recursively. Files smaller than 'pack_limit' are packed into
+# tar archives of about PACK_SIZE bytes, each sent as a 'cp' request with
+# 'P: tar' and the hash of the archive in 'H'. The first pack holds all dirs,
+# so that the tree exists before any file arrives. Larger files are copied one
+# by one at the same time, at most 'transfer_streams' of them at once.
+# At last, the whole tree is registered to tracker again in a batch of deltas.
+# When a dir is pulled, src host answers a 'cp' with 'P: tar' by frames like
+# 'P: tar\nH: hash\nL: length\n\n' followed by a pack, then a frame 'P: end'
+# followed by a json list of large files like [[path, size]].
+
+PACK_LIMIT = 1024 * 1024
+PACK_SIZE = 16 * 1024 * 1024
+
+# Split the tree under local dir 'root' into packs of small files and a list
+# of large files, both like [[path, size]]. Paths are relative to 'root'.
+def plan_packs(root):
+    pack_limit = config.get('pack_limit', PACK_LIMIT)
+    dirs, packs, large = [], [], []
+    pack, pack_size = [], 0
+    for path, is_file, stat in scan_path(root):
+        name = path[len(root) + 1:]
+        if not is_file:
+            dirs.append([name, 0])  # parents are always before children
+        elif stat.st_size >= pack_limit:
+            large.append([name, stat.st_size])
+        else:
+            if pack and pack_size + stat.st_size > PACK_SIZE:
+                packs.append(pack)
+                pack, pack_size = [], 0
+            pack.append([name, stat.st_size])
+            pack_size += stat.st_size + 512  # with its tar header
+    if pack:
+        packs.append(pack)
+    return [dirs] + packs, large
+
+# return a tar archive of 'pack' (see 'plan_packs') in local dir 'root' and its hash
+def make_pack(root, pack):
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode='w') as tar:
+        for name, _ in pack:
+            try:
+                tar.add(root + '/' + name, arcname=name, recursive=False)
+            except OSError as e:  # removed after 'plan_packs'
+                logging.warning(f'Skip {name!r}: {e!r}')
+    data = buffer.getvalue()
+    pack_hash = new_hash()
+    pack_hash.update(data)
+    return data, pack_hash.hexdigest()
+
+# Unpack tar archive 'data' into local dir 'root', return the number of paths.
+# Raise ValueError if it doesn't match 'pack_hash' or has a path out of 'root'.
+def extract_pack(data, root, pack_hash):
+    received_hash = new_hash()
+    received_hash.update(data)
+    if received_hash.hexdigest() != pack_hash:
+        raise ValueError('A pack is received with a wrong hash')
+    with tarfile.open(fileobj=io.BytesIO(data), mode='r') as tar:
+        members = tar.getmembers()
+        for member in members:
+            if (member.name.startswith('/') or '..' in member.name.split('/') 
+                    or not (member.isfile() or member.isdir())):
+                raise ValueError(f'Illegal path in pack: {member.name!r}')
+        os.makedirs(root, exist_ok=True)
+        if hasattr(tarfile, 'data_filter'):
+            tar.extractall(root, members, filter='data')
+        else:
+            tar.extractall(root, members)
+    return len(members)
+
+# Send packs and the list of large files of local dir 'root' as frames, the
+# next pack is made while one is being sent. Packs are compressed by 'codec'.
+async def send_packs(root, writer, codec=None):
+    loop = asyncio.get_running_loop()
+    packs, large = await loop.run_in_executor(None, plan_packs, root)
+    making = loop.run_in_executor(None, make_pack, root, packs[0])
+    for i in range(len(packs)):
+        data, pack_hash = await making
+        if i + 1 < len(packs):
+            making = loop.run_in_executor(None, make_pack, root, packs[i + 1])
+        header = f'P: tar\nH: {pack_hash}\nL: {len(data)}\n'
+        if codec:
+            header += f'Z: {codec}\n'
+        writer.write((header + '\n').encode('utf-8'))
+        await send_pack_data(writer, data, codec)
+    content = json.dumps(large).encode('utf-8')
+    writer.write(f'P: end\nL: {len(content)}\n\n'.encode('utf-8') + content)
+    await writer.drain()
+    logging.info(f'Send {len(packs)} packs of {root!r}, and {len(large)} large files')
+
+async def send_pack_data(writer, data, codec):
+    if codec:
+        view = memoryview(data)
+        await send_compressed(writer, lambda offset, size: view[offset: offset + size],
+                              len(data), codec)
+    else:
+        writer.write(data)
+        await writer.drain()
+        count('bytes_sent', len(data))
+
+# the hash of local file 'path' if it's known by 'hash_file'
+def known_hash(path):
+    known = file_hashes.get(path)
+    if known is None or not known[1].done() or known[1].cancelled():
+        return None
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    if known[0] != (stat.st_size, stat.st_mtime_ns) or known[1].exception():
+        return None
+    return known[1].result()
+
+# deltas that replace local path 'path' (in root) and everything under it
+def tree_deltas(path):
+    physical_path = parse_physical_path(root_to_physical(path, is_dir=False))[1]
+    deltas = [['d', physical_path], ['a', path_record(path, os.stat(path))]]
+    if os.path.isdir(path):
+        deltas += [['a', record] for record in make_records(path)]
+    return deltas
+
+# register local path 'path' (in root) with everything under it to tracker again
+async def register_tree_again(path):
+    loop = asyncio.get_running_loop()
+    deltas = await loop.run_in_executor(None, tree_deltas, path)
+    for _, record in deltas[1:]:
+        record.append(known_hash(config['root'] + record[0]) if record[2] else None)
+    await send_deltas(deltas)
+
+
+#-------------------------------Third-party Copy-------------------------------#
+# A shell copies a file or dir between two other hosts by sending 'cp src dst'
+# (or 'mv') with 'D: push' to src host, which pushes it to dst host the same
+# way as a shell does, so the data crosses the network once. While copying,
+# src host answers with frames like 'S: done total\n\n' every PROGRESS_INTERVAL
+# seconds, and with the 'E' line at last.
+
+PROGRESS_INTERVAL = 1
+
+# bytes of the files of a copy, and those copied so far
+class Progress:
+    def __init__(self):
+        self.total = 0
+        self.done = 0
+
+    def add(self, size):
+        self.done += size
+
+
 ################################################################################
 #---------------------------------Daemon Side----------------------------------#
 
@@ -117,115 +1425,338 @@ async def send_file(src, dst, writer, loop):
 def root_to_relative(localpath):
     return localpath.split(config['root'])[1]
 
-def root_to_physical(path, in_default_root=True):
+def root_to_physical(path, in_default_root=True, is_dir=None):
     global config
-    if os.path.isdir(path): path += '/'  # identify a dir
+    if is_dir is None:
+        is_dir = os.path.isdir(path)
+    if is_dir: path += '/'  # identify a dir
     if in_default_root:
         path = root_to_relative(path)
     else:
         path = '/' + path
     return '//' + config['ip'] + ':' + config['port'] + path
 
-async def load_path(root, logical_root=None, cursor=None, 
-                    in_default_root=True, is_tracker=True):
-    global config
+def format_time(stamp):
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(stamp))
+
+# Walk 'root' (a dir) with os.scandir, yield (path, is_file, stat) of
+# every path under it. Paths of dirs don't end with '/'.
+def scan_path(root):
+    stack = [root.rstrip('/')]
+    while stack:
+        top = stack.pop()
+        try:
+            with os.scandir(top) as it:
+                entries = list(it)
+        except OSError as e:
+            logging.warning(f'Fail to scan {top!r}: {e!r}')
+            continue
+        for entry in entries:
+            if is_partial(entry.name):
+                continue  # a file being copied
+            path = top + '/' + entry.name
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue  # removed while scanning
+            is_dir = entry.is_dir()
+            yield path, entry.is_file(), stat
+            if is_dir:
+                stack.append(path)
+
+# make the records of bulk registration, which are like
+# [physical_path, logical_path, is_file, ctime, mtime, size]
+def make_records(root, logical_root=None, in_default_root=True):
     if os.path.isdir(root):
-        path_list = [root + subpath for subpath in os.listdir(root)]
+        entries = scan_path(root)
+        root = root.rstrip('/') + '/'
     else:
-        path_list = [root]
-    for path in path_list:
-        if is_tracker: # this daemon has the meta database
-            logging.info('loading ' + path)
-            ctime_stamp = os.path.getctime(path)
-            mtime_stamp = os.path.getmtime(path)
-            ctime = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(ctime_stamp))
-            mtime = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(mtime_stamp))
-            await cursor.execute('''
-                insert into filesystem
-                (physical_path, category, ctime, mtime, size, host_addr, host_name)
-                values  (?, ?, ?, ?, ?, ?, ?)
-                ''', 
-                (root_to_relative(path) , os.path.isfile(path), 
-                ctime, mtime, os.path.getsize(path), 
-                config['ip'] + ':' + config['port'], config['name'])
-            )
-            await metaDB.commit()
-        else:  # this side don't have the meta database
-            if logical_root:
-                logical_path = logical_root + os.path.split(path)[1]
-                cmd = 'ln ' + root_to_physical(path, in_default_root) + ' ' + logical_path
-            else:
-                cmd = 'ln ' + root_to_physical(path, in_default_root)
-            header = make_header(cmd, os.path.getsize(path))
+        entries = [(root, True, os.stat(root))]
+        root = os.path.split(root)[0] + '/'
+    for path, is_file, stat in entries:
+        physical = root_to_physical(path, in_default_root, is_dir=False)
+        logical_path = logical_root + path[len(root):] if logical_root else None
+        yield [parse_physical_path(physical)[1], logical_path, is_file, 
+                stat.st_ctime, stat.st_mtime, stat.st_size]
 
-            reader, writer = await asyncio.open_connection(
-                            config['tracker_ip'], config['tracker_port'])
-            logging.debug(f'Send: {header!r}')
-            writer.write(header.encode('utf-8'))
-            await writer.drain()
-            if await get_error(reader, writer):
+# Register everything under 'root' to tracker by 'rg' requests, each of which
+# carries a chunk of records. Several chunks are sent at the same time.
+# Records linked to 'logical_root' go to the tracker holding it, and others
+# to the one holding this host.
+async def register_tree(root, logical_root=None, in_default_root=True):
+    location = '//' + config['ip'] + ':' + config['port']
+    key = logical_root or '//' + config['name']
+    window = asyncio.Semaphore(BULK_WINDOW)
+    failed = False
+    count = 0
+    start = time.time()
+
+    async def send_chunk(chunk):
+        nonlocal failed, count
+        try:
+            content = json.dumps(chunk).encode('utf-8')
+            err_msg, _ = await shard_request(key, 'rg ' + location, content=content)
+            if check_error(err_msg):
+                failed = True
                 return
-            logging.info('Link ' + path + ' successfully')
-            writer.close()
+            count += len(chunk)
+            rate = count / max(time.time() - start, 1e-6)
+            logging.info(f'Registered {count} paths ({rate:.0f} records/s)')
+        except (asyncio.IncompleteReadError, OSError) as e: # tracker is unreachable
+            logging.error(f'Fail to register {len(chunk)} paths: {e!r}')
+            failed = True
+        finally:
+            window.release()
 
-        # recursive load path
-        if os.path.isdir(path):
-            if logical_root:
-                await load_path(path + '/', cursor=cursor, 
-                    logical_root=logical_root + os.path.split(path)[1] + '/', 
-                    in_default_root=in_default_root, is_tracker=is_tracker)
-            else:
-                await load_path(path + '/', cursor=cursor, 
-                    in_default_root=in_default_root, is_tracker=is_tracker)
+    tasks = []
+    chunk = []
+    for record in make_records(root, logical_root, in_default_root):
+        chunk.append(record)
+        if len(chunk) == BULK_CHUNK:
+            await window.acquire()
+            if failed:
+                break
+            tasks.append(asyncio.create_task(send_chunk(chunk)))
+            chunk = []
+    else:
+        if chunk:
+            await window.acquire()
+            tasks.append(asyncio.create_task(send_chunk(chunk)))
+    await asyncio.gather(*tasks)
+    if failed:
+        logging.error(f'Fail to register {root!r}, {count} paths registered')
+        return False
+    elapsed = time.time() - start
+    logging.info(f'Register {count} paths under {root!r} in {elapsed:.2f}s '
+                 f'({count / max(elapsed, 1e-6):.0f} records/s)')
+    return True
+
+# Digest of a dir, made from (name, is_file, size, mtime, digest) of its
+# children, where 'digest' is the child's digest if it's a dir. Thus the
+# digest of a dir changes if anything under it changes (a Merkle tree).
+# 'mtime' is formatted as what is stored in meta database, so tracker
+# and daemons should use the same timezone.
+def make_digest(items):
+    sha1 = hashlib.sha1()
+    for name, is_file, size, mtime, digest in sorted(items):
+        sha1.update(f'{name}\0{int(bool(is_file))}\0{size}\0{mtime}\0{digest or ""}\n'
+                    .encode('utf-8'))
+    return sha1.hexdigest()
+
+# Scan 'root' (a dir) once, return the digest of every dir under it and 
+# the listing of every dir, ie. map its path to [its record, records of 
+# its children], records are made by 'make_records'.
+def scan_digests(root):
+    root = root.rstrip('/') + '/'
+    stat = os.stat(root)
+    listing = {'/': [['/', None, False, stat.st_ctime, stat.st_mtime, stat.st_size], []]}
+    for record in make_records(root):
+        path = record[0]
+        if not record[2]: # not a file
+            listing.setdefault(path, [None, []])[0] = record
+        listing.setdefault(parent_of(path), [None, []])[1].append(record)
+    digests = {}
+    # make digests of deeper dirs first, and root at last
+    for path in sorted(listing, key=lambda p: p.count('/') if p != '/' else 0, 
+                       reverse=True):
+        digests[path] = make_digest(
+            (record[0].rsplit('/', 1)[1], record[2], record[5], 
+             format_time(record[4]), digests.get(record[0]))
+            for record in listing[path][1])
+    return digests, listing
+
+# group listings of 'dirs' into batches of about 'limit' records,
+# each listing in a batch is like [dir, record of dir, records of its children]
+def batch_listings(listing, dirs, limit):
+    batches = []
+    count = limit
+    for path in dirs:
+        if count >= limit:
+            batches.append([])
+            count = 0
+        record, children = listing[path]
+        batches[-1].append([path, record, children])
+        count += len(children) + 1
+    return batches
+
+# the dirs in 'listing' whose parents are in 'dirs'
+def child_dirs_in(listing, dirs):
+    return [record[0] for path in dirs for record in listing[path][1] 
+            if record[0] in listing]
+
+# Resync the paths under 'root' with tracker, level by level from root: 
+# send digests of dirs by 'dg' requests, and tracker tells which of them
+# differ from what it has. Only the listings of these dirs are sent again 
+# by 'rs' requests, then we go on with their children.
+# Return False if tracker doesn't know this host at all.
+async def resync_tree(root):
+    loop = asyncio.get_running_loop()
+    location = '//' + config['ip'] + ':' + config['port']
+    start = time.time()
+    digests, listing = await loop.run_in_executor(None, scan_digests, root)
+    messages = 0
+    rewritten = 0
+    frontier = ['/']
+    while frontier:
+        differ = []
+        for i in range(0, len(frontier), BULK_CHUNK):
+            chunk = {path: digests[path] for path in frontier[i: i + BULK_CHUNK]}
+            err_msg, data = await shard_request('//' + config['name'],
+                'dg ' + location, content=json.dumps(chunk).encode('utf-8'))
+            messages += 1
+            if check_error(err_msg): # eg. an older tracker
+                return False
+            response = json.loads(data)
+            if not response['known']:
+                return False
+            differ += response['differ']
+
+        # send listings of changed dirs, a batch of them in a request
+        window = asyncio.Semaphore(BULK_WINDOW)
+        async def send_batch(batch):
+            async with window:
+                err_msg, _ = await shard_request('//' + config['name'],
+                    'rs ' + location, content=json.dumps(batch).encode('utf-8'))
+                check_error(err_msg)
+        batches = batch_listings(listing, differ, BULK_CHUNK)
+        await asyncio.gather(*[send_batch(batch) for batch in batches])
+        messages += len(batches)
+        rewritten += len(differ)
+        frontier = child_dirs_in(listing, differ)
+
+    logging.info(f'Resync {root!r} in {time.time() - start:.2f}s: {rewritten} of '
+                 f'{len(listing)} dirs rewritten, {messages} messages')
+    return True
+
+# Scan paths under 'root' into meta database in this host (the tracker),
+# every SCAN_BATCH rows are inserted in one transaction.
+async def scan_into_db(root, logical_root=None, in_default_root=True):
+    loop = asyncio.get_running_loop()
+    location = config['ip'] + ':' + config['port']
+    records = make_records(root, logical_root, in_default_root)
+    count = 0
+    start = time.time()
+    while True:
+        # walk the disk in another thread while the loop serves requests
+        chunk = await loop.run_in_executor(
+                    None, lambda: list(itertools.islice(records, SCAN_BATCH)))
+        if not chunk:
+            break
+        count += await insert_records(chunk, location, config['name'])
+        rate = count / max(time.time() - start, 1e-6)
+        logging.info(f'Loaded {count} paths ({rate:.0f} rows/s)')
+    elapsed = time.time() - start
+    logging.info(f'Load {count} paths under {root!r} in {elapsed:.2f}s '
+                 f'({count / max(elapsed, 1e-6):.0f} rows/s)')
+
+async def load_path(root, logical_root=None, 
+                    in_default_root=True, is_tracker=True):
+    if is_tracker: # this daemon has the meta database
+        await scan_into_db(root, logical_root, in_default_root)
+    else:  # this side don't have the meta database
+        await register_tree(root, logical_root, in_default_root)
 
 async def update_db():
     global config, metaDB
     path = config['root']
     if config['istracker']: # this is tracker
+        # only rewrite what has changed since last time
+        if await resync_local(path):
+            return
+
         cursor = await metaDB.cursor()
         await cursor.execute('delete from filesystem where host_addr = ?', 
                         (config['ip'] + ':' + config['port'],))
+        cache_drop_host(config['ip'] + ':' + config['port'])
         
         # record root physical path
         logging.info('loading ' + path)
-        ctime_stamp = os.path.getctime(path)
-        mtime_stamp = os.path.getmtime(path)
-        ctime = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(ctime_stamp))
-        mtime = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(mtime_stamp))
+        stat = os.stat(path)
         await cursor.execute('''
             insert into filesystem
             (physical_path, category, ctime, mtime, size, host_addr, host_name)
             values  ('/', ?, ?, ?, ?, ?, ?)
             ''', 
-            (os.path.isfile(path), ctime, mtime, os.path.getsize(path), 
+            (os.path.isfile(path), format_time(stat.st_ctime), 
+            format_time(stat.st_mtime), stat.st_size, 
             config['ip'] + ':' + config['port'], config['name'])
         )
-        await metaDB.commit()
+        await cursor.close()
+        cache_add(None, '/', os.path.isfile(path), format_time(stat.st_ctime), 
+                format_time(stat.st_mtime), stat.st_size, 
+                config['ip'] + ':' + config['port'], config['name'])
 
         # insert physical paths in this host
-        await load_path(config['root'] + '/', cursor=cursor)
-        await cursor.close()
+        await load_path(config['root'] + '/')
+        await metaDB.commit()
     else:
+        # only resend what has changed since last time
+        if await resync_tree(path):
+            return
+
         # ln root physical path
-        header = make_header('ln ' + root_to_physical(path), os.path.getsize(path))
-        reader, writer = await asyncio.open_connection(
-                        config['tracker_ip'], config['tracker_port'])
-        logging.debug(f'Send: {header!r}')
-        writer.write(header.encode('utf-8'))
-        await writer.drain()
-        if await get_error(reader, writer):
+        err_msg, _ = await shard_request('//' + config['name'], 
+                                         'ln ' + root_to_physical(path), 
+                                         os.path.getsize(path))
+        if check_error(err_msg):
             return
         logging.info('Link ' + path + ' successfully')
-        writer.close()
 
         await load_path(config['root'] + '/', is_tracker=False)
 
 
+# parent of a logical or physical path, None for root
+def parent_of(path):
+    if not path or path == '/':
+        return None
+    return path.rstrip('/').rsplit('/', 1)[0] or '/'
+
+# Upgrade the meta database created by an older version,
+# 'version' is the schema version recorded in the database.
+async def migrate_db(cursor, version):
+    if version < 1: # add parent columns
+        logging.info('Migrating meta database to schema version 1...')
+        await cursor.execute('alter table filesystem add column logical_parent varchar')
+        await cursor.execute('alter table filesystem add column physical_parent varchar')
+        await cursor.execute('select rowid, logical_path, physical_path from filesystem')
+        rows = []
+        for rowid, logical_path, physical_path in await cursor.fetchall():
+            if logical_path: # physical path of a link is not a child in its host
+                rows.append((parent_of(logical_path), None, rowid))
+            else:
+                rows.append((None, parent_of(physical_path), rowid))
+        await cursor.executemany('''
+            update filesystem set logical_parent = ?, physical_parent = ?
+            where rowid = ?
+            ''', rows)
+    if version < 2: # add content hash
+        logging.info('Migrating meta database to schema version 2...')
+        await cursor.execute('alter table filesystem add column hash varchar')
+    await cursor.execute(f'pragma user_version = {SCHEMA_VERSION}')
+
 async def init_db():
     global config, metaDB
     loop = asyncio.get_running_loop()
-    metaDB = await aiosqlite3.connect('pns.sqlite3', loop=loop)
+    metaDB = TimedConnection(
+        await aiosqlite3.connect(config.get('db', 'pns.sqlite3'), loop=loop))
     cursor = await metaDB.cursor()
+    # readers don't block the writer in WAL mode, and with 'synchronous = normal' 
+    # a commit doesn't wait for fsync, only a checkpoint does
+    journal_mode = config.get('journal_mode', 'wal')
+    synchronous = config.get('synchronous', 'normal')
+    if synchronous is False: # yaml reads 'off' as a boolean
+        synchronous = 'off'
+    if journal_mode not in ('wal', 'delete', 'truncate', 'persist', 'memory'):
+        raise ValueError(f'invalid journal_mode {journal_mode!r}')
+    if synchronous not in ('off', 'normal', 'full', 'extra'):
+        raise ValueError(f'invalid synchronous {synchronous!r}')
+    await cursor.execute(f'pragma journal_mode = {journal_mode}')
+    await cursor.execute(f'pragma synchronous = {synchronous}')
+    start_committer()
+    await cursor.execute('''
+        select count(*) from sqlite_master where type = 'table' and name = 'filesystem'
+        ''')
+    is_new = (await cursor.fetchone())[0] == 0
     # Both directory and file paths don't end with '/',
     # except logical root path
     await cursor.execute('''
@@ -237,9 +1768,34 @@ async def init_db():
         mtime         varchar,
         size          int,         -- zero for dir
         host_addr     varchar,     -- ip and port
-        host_name     varchar
+        host_name     varchar,
+        logical_parent  varchar,   -- parent of logical_path, null for '/'
+        physical_parent varchar,   -- parent of physical_path, null for links
+        hash          varchar      -- content hash of a file, null if unknown
     )
     ''')
+    if is_new:
+        await cursor.execute(f'pragma user_version = {SCHEMA_VERSION}')
+    else:
+        await cursor.execute('pragma user_version')
+        version = (await cursor.fetchone())[0]
+        if version < SCHEMA_VERSION:
+            await migrate_db(cursor, version)
+    # listing a dir looks up children by parent, 
+    # existence checks look up a path
+    await cursor.execute('''create index if not exists idx_logical_path
+                            on filesystem (logical_path)''')
+    await cursor.execute('''create index if not exists idx_logical_children
+                            on filesystem (logical_parent, logical_path)''')
+    await cursor.execute('''create index if not exists idx_host_physical_path
+                            on filesystem (host_addr, physical_path)''')
+    await cursor.execute('''create index if not exists idx_host_physical_children
+                            on filesystem (host_addr, physical_parent, physical_path)''')
+    await cursor.execute('''create index if not exists idx_host_name_children
+                            on filesystem (host_name, physical_parent, physical_path)''')
+    # looking for copies of a file
+    await cursor.execute('''create index if not exists idx_hash
+                            on filesystem (hash)''')
     
     # if the database is empty, 
     # this is the first time we start the tracker
@@ -254,7 +1810,466 @@ async def init_db():
             ''', (now, now)
         )
     await metaDB.commit()
+    if config.get('cache', True):
+        await load_cache(cursor)
+    await cursor.close()
+    # readers only don't block the writer in WAL mode
+    if journal_mode == 'wal':
+        await open_readers(config.get('db_readers', DB_READERS))
+
+
+#----------------------------------Group Commit--------------------------------#
+# Requests changing the meta database don't commit by themselves. They wait in
+# 'commit_waiters' for a single committer, which commits the changes made by
+# all of them so far in one transaction, so concurrent registrations share
+# a sync of the database instead of each paying for one.
+
+commit_waiters = [] # futures of requests waiting for the next commit
+commit_wakeup = None
+commit_full = None
+
+def start_committer():
+    global commit_wakeup, commit_full
+    commit_wakeup = asyncio.Event()
+    commit_full = asyncio.Event()
+    asyncio.create_task(group_committer())
+
+# make what the current request has written to meta database durable
+async def commit_db():
+    future = asyncio.get_running_loop().create_future()
+    commit_waiters.append(future)
+    commit_wakeup.set()
+    if len(commit_waiters) >= COMMIT_GROUP:
+        commit_full.set()
+    await timed_db(future)
+
+async def group_committer():
+    global commit_waiters
+    window = config.get('commit_window', COMMIT_WINDOW)
+    while True:
+        await commit_wakeup.wait()
+        commit_wakeup.clear()
+        if window and len(commit_waiters) < COMMIT_GROUP:
+            try:
+                await asyncio.wait_for(commit_full.wait(), window)
+            except asyncio.TimeoutError:
+                pass
+        commit_full.clear()
+        waiters, commit_waiters = commit_waiters, []
+        if not waiters:
+            continue
+        start = time.perf_counter()
+        try:
+            await metaDB.commit()
+        except Exception as e:
+            logging.error(f'commit of {len(waiters)} requests failed: {e!r}')
+            for future in waiters:
+                if not future.done():
+                    future.set_exception(e)
+            continue
+        observe('commit_seconds', time.perf_counter() - start)
+        count('commits')
+        count('committed_requests', len(waiters))
+        for future in waiters:
+            if not future.done():
+                future.set_result(None)
+
+
+#-----------------------------------Reader Pool--------------------------------#
+# Reads that may scan many rows are served by a pool of read-only connections,
+# each running its queries in its own thread, so that they neither wait for
+# nor hold up the writes on 'metaDB'. A reader sees what has been committed,
+# which includes everything of the requests answered so far.
+
+meta_readers = None # a queue of idle reader connections, None if no pool
+
+async def open_readers(number):
+    global meta_readers
+    if number <= 0:
+        return
+    loop = asyncio.get_running_loop()
+    uri = 'file:' + os.path.abspath(config.get('db', 'pns.sqlite3')) + '?mode=ro'
+    meta_readers = asyncio.Queue()
+    for _ in range(number):
+        meta_readers.put_nowait(TimedConnection(
+            await aiosqlite3.connect(uri, loop=loop, uri=True)))
+
+async def close_readers():
+    while meta_readers and not meta_readers.empty():
+        await meta_readers.get_nowait().close()
+
+# borrow a reader connection, or 'metaDB' if there's no pool
+@contextlib.asynccontextmanager
+async def read_db():
+    if meta_readers is None:
+        yield metaDB
+        return
+    connection = await meta_readers.get()
+    try:
+        yield connection
+    finally:
+        meta_readers.put_nowait(connection)
+
+
+#--------------------------------Namespace Cache-------------------------------#
+# Tracker keeps what's in the filesystem table in memory: a tree for the
+# logical namespace and a tree for each host's physical namespace.
+# Every change to the table is written through to these trees,
+# so that ls and existence checks don't touch the database.
+# A node whose 'category' is None is a placeholder for a dir whose own row
+# isn't in the table (yet), eg. 'rg' requests may be handled out of order.
+
+class Node:
+    __slots__ = ('name', 'parent', 'children', 'category', 'ctime', 'mtime', 
+                 'size', 'target', 'host', 'hash', 'digest', 'names')
+
+    def __init__(self, name, parent):
+        self.name = name
+        self.parent = parent
+        self.children = None  # map name to child node, None for file
+        self.category = None
+        self.ctime = None
+        self.mtime = None
+        self.size = None
+        self.target = None    # physical path of a link
+        self.host = None      # host_addr of a link
+        self.hash = None      # content hash of a file, if known
+        self.digest = None    # see 'node_digest', None if not computed
+        self.names = None     # sorted names of children, None if not computed
+
+    def path(self):
+        names = []
+        node = self
+        while node.parent is not None:
+            names.append(node.name)
+            node = node.parent
+        return '/' + '/'.join(reversed(names))
+
+    # names of children in order, to list them a page after another
+    def sorted_names(self):
+        if self.names is None:
+            self.names = sorted(self.children)
+        return self.names
+
+    # forget digests of this node and its ancestors
+    def invalidate(self):
+        node = self
+        while node is not None and node.digest is not None:
+            node.digest = None
+            node = node.parent
+
+    def set_row(self, category, ctime, mtime, size, target=None, host=None, 
+                file_hash=None):
+        self.invalidate()
+        self.category = category
+        self.ctime = ctime
+        self.mtime = mtime
+        self.size = size
+        self.target = target
+        self.host = host
+        self.hash = file_hash
+
+    # detach this node, or just its row if it still has children
+    def remove(self):
+        if self.children or self.parent is None:
+            self.set_row(None, None, None, None)
+        else:
+            self.remove_tree()
+
+    # detach this node with all nodes under it
+    def remove_tree(self):
+        self.invalidate()
+        if self.parent is None:
+            self.set_row(None, None, None, None)
+            self.children = {}
+            self.names = None
+        else:
+            del self.parent.children[self.name]
+            self.parent.names = None
+
+
+logical_tree = None # root of logical namespace, None if cache is disabled
+host_trees = {}     # map host_addr to the root of its physical namespace
+host_names = {}     # map host_addr to host_name
+
+def split_path(path):
+    return [name for name in path.split('/') if name]
+
+def find_node(root, path, create=False):
+    node = root
+    for name in split_path(path):
+        if not node.children or name not in node.children:
+            if not create:
+                return None
+            if node.children is None:
+                node.children = {}
+            node.children[name] = Node(name, node)
+            node.names = None
+        node = node.children[name]
+    return node
+
+# the same as 'find_node', but skip placeholders
+def find_row(root, path):
+    node = find_node(root, path)
+    if node is None or node.category is None:
+        return None
+    return node
+
+# roots of the physical namespace of the host(s) denoted by 'location'
+def find_host_trees(location):
+    if location.find('.') != -1: # if location denotes an 'ip:port'
+        return [host_trees[location]] if location in host_trees else []
+    return [host_trees[addr] for addr, name in host_names.items()
+            if name == location and addr in host_trees]
+
+# write a row of filesystem table through to the cache
+def cache_add(logical_path, physical_path, category, ctime, mtime, size,
+              host_addr, host_name, file_hash=None):
+    if logical_tree is None:
+        return
+    if logical_path:
+        node = find_node(logical_tree, logical_path, create=True)
+        node.set_row(category, ctime, mtime, size, physical_path, host_addr)
+    else:
+        if host_addr not in host_trees:
+            host_trees[host_addr] = Node('', None)
+            host_names[host_addr] = host_name
+        node = find_node(host_trees[host_addr], physical_path, create=True)
+        node.set_row(category, ctime, mtime, size, file_hash=file_hash)
+    if category == 0 and node.children is None:
+        node.children = {}
+
+def cache_remove_logical(path):
+    node = find_node(logical_tree, path) if logical_tree else None
+    if node:
+        node.remove_tree()
+
+def cache_remove_physical(location, path):
+    if logical_tree is None:
+        return
+    for root in find_host_trees(location):
+        node = find_node(root, path)
+        if node:
+            node.remove()
+
+# turn a logical link into a physical path in its host
+def cache_disconnect(path):
+    node = find_row(logical_tree, path) if logical_tree else None
+    if node:
+        cache_add(None, node.target, node.category, node.ctime, node.mtime,
+                  node.size, node.host, host_names.get(node.host))
+        node.remove()
+
+# forget a host, and links to its paths
+def cache_drop_host(location):
+    if logical_tree is None:
+        return
+    addrs = {addr for addr, name in host_names.items()
+             if location in (addr, name)}
+    for addr in addrs:
+        host_trees.pop(addr, None)
+        host_names.pop(addr, None)
+    stack = [logical_tree]
+    while stack:
+        node = stack.pop()
+        if node.children:
+            stack.extend(list(node.children.values()))
+        if node.host in addrs:
+            node.remove()
+
+async def load_cache(cursor):
+    global logical_tree
+    start = time.time()
+    logical_tree = Node('', None)
+    host_trees.clear()
+    host_names.clear()
+    await cursor.execute('''
+        select logical_path, physical_path, category, ctime, mtime, size,
+        host_addr, host_name, hash from filesystem
+        ''')
+    count = 0
+    while True:
+        rows = await cursor.fetchmany(SCAN_BATCH)
+        if not rows:
+            break
+        for row in rows:
+            cache_add(*row)
+        count += len(rows)
+    logging.info(f'Load {count} rows into namespace cache in {time.time() - start:.2f}s')
+
+# Results of 'ls' from cache, and the name to list the next page after (None
+# for the last page). The first page starts with 'dst' itself, and at most
+# 'limit' entries are returned, after the child named 'after'. 
+# Return (None, None) if 'dst' is not found.
+def cache_ls(dst, after=None, limit=None):
+    file_list = []
+    if dst == '//': # fetch all hosts' info
+        for addr, root in host_trees.items():
+            if addr not in offline_addrs:
+                file_list.append({'name': host_names[addr], 'addr': addr})
+        file_list.sort(key=lambda item: item['name']) # ordered as any listing
+        return file_list or None, None
+
+    if dst.startswith('//'): # physical path
+        location, path = parse_physical_path(dst.rstrip('/'))
+        node = None
+        for root in find_host_trees(location):
+            addr = next(addr for addr, tree in host_trees.items() if tree is root)
+            if addr not in offline_addrs:
+                node = find_node(root, path)
+                if node is not None:
+                    break
+        def make_item(node):
+            return {
+                'name' : node.path(),
+                'type' : 'f' if node.category else 'd',
+                'ctime': node.ctime,
+                'mtime': node.mtime,
+                'size' : node.size,
+                'host' : addr, # ip and port
+                'hash' : node.hash
+            }
+    else: # logical path
+        node = find_node(logical_tree, dst)
+        def make_item(node):
+            return {
+                'name' : node.path(),
+                'type' : node.target, # the physical path for this logical path
+                'ctime': node.ctime,
+                'mtime': node.mtime,
+                'size' : node.size,
+                'host' : node.host  # ip and port
+            }
+    if node is None:
+        return None, None
+
+    if after is None and node.category is not None and node.host not in offline_addrs:
+        file_list.append(make_item(node))
+    next_name = None
+    if node.children:
+        names = node.sorted_names()
+        i = 0 if after is None else bisect.bisect_right(names, after)
+        while i < len(names):
+            if limit is not None and len(file_list) >= limit:
+                next_name = names[i - 1] if i > 0 else ''
+                break
+            child = node.children[names[i]]
+            i += 1
+            if child.category is not None and child.host not in offline_addrs:
+                file_list.append(make_item(child))
+    if not file_list and after is None:
+        return None, None
+    return file_list, next_name
+
+
+# digest of a dir node, the same as what 'scan_digests' makes for the dir
+def node_digest(node):
+    if node.digest is None:
+        items = []
+        for child in (node.children or {}).values():
+            if child.category is None:
+                continue
+            digest = node_digest(child) if not child.category else None
+            items.append((child.name, child.category, child.size, child.mtime, digest))
+        node.digest = make_digest(items)
+    return node.digest
+
+# Root of the physical namespace of host 'host_addr', None if unknown. 
+# Without the cache, a tree is built from database every time.
+async def host_tree(host_addr):
+    if logical_tree is not None:
+        return host_trees.get(host_addr)
+    cursor = await metaDB.cursor()
+    await cursor.execute('''
+        select physical_path, category, ctime, mtime, size from filesystem
+        where host_addr = ? and logical_path is null
+        ''', (host_addr,))
+    root = None
+    while True:
+        rows = await cursor.fetchmany(SCAN_BATCH)
+        if not rows:
+            break
+        root = root or Node('', None)
+        for path, category, ctime, mtime, size in rows:
+            node = find_node(root, path, create=True)
+            node.set_row(category, ctime, mtime, size)
+    await cursor.close()
+    return root
+
+# the dirs in 'digests' (map path to digest) that differ from 'root'
+def diff_digests(root, digests):
+    differ = []
+    for path, digest in digests.items():
+        node = find_row(root, path) if root else None
+        if node is None or node_digest(node) != digest:
+            differ.append(path)
+    return differ
+
+# Replace the listings of some dirs of a host in one transaction.
+# 'listings' is a list of [dir, record of dir, records of its children].
+async def replace_dirs(host_addr, host_name, listings):
+    global metaDB
+    cursor = await metaDB.cursor()
+    records = []
+    for path, record, children in listings:
+        names = {child[0] for child in children}
+        # a dir that's a file now is gone as well
+        files = {child[0] for child in children if child[2]}
+        if logical_tree is not None:
+            node = find_node(host_trees.get(host_addr, Node('', None)), path)
+            gone = [child for child in (node.children or {}).values() 
+                    if child.path() not in names 
+                    or (child.children and child.path() in files)] if node else []
+            old_dirs = [child.path() for child in gone if child.children]
+        else:
+            await cursor.execute('''
+                select physical_path from filesystem 
+                where host_addr = ? and physical_parent = ? and category = 0
+                    and logical_path is null
+                ''', (host_addr, path))
+            old_dirs = [row[0] for row in await cursor.fetchall() 
+                        if row[0] not in names or row[0] in files]
+            gone = []
+        # the dir itself and its children
+        await cursor.execute('''
+            delete from filesystem
+            where host_addr = ? and logical_path is null 
+                and (physical_path = ? or physical_parent = ?)
+            ''', (host_addr, path, path))
+        # everything under the dirs that are gone
+        for old_dir in old_dirs:
+            await cursor.execute('''
+                delete from filesystem
+                where host_addr = ? and logical_path is null 
+                    and physical_path > ? and physical_path < ?
+                ''', (host_addr, old_dir + '/', old_dir + '0'))
+        for child in gone:
+            child.remove_tree()
+        records.append(record)
+        records += children
     await cursor.close()
+    return await insert_records(records, host_addr, host_name)
+
+# tracker's version of 'resync_tree', which compares digests without network
+async def resync_local(root):
+    loop = asyncio.get_running_loop()
+    location = config['ip'] + ':' + config['port']
+    start = time.time()
+    tree = await host_tree(location)
+    if tree is None or tree.category is None:
+        return False
+    digests, listing = await loop.run_in_executor(None, scan_digests, root)
+    rewritten = 0
+    frontier = ['/']
+    while frontier:
+        differ = diff_digests(tree, {path: digests[path] for path in frontier})
+        for batch in batch_listings(listing, differ, SCAN_BATCH):
+            await replace_dirs(location, config['name'], batch)
+        rewritten += len(differ)
+        frontier = child_dirs_in(listing, differ)
+    logging.info(f'Resync {root!r} in {time.time() - start:.2f}s: '
+                 f'{rewritten} of {len(listing)} dirs rewritten')
+    return True
 
 
 #------------------------------Callback & Utilities---------------------------#
@@ -272,22 +2287,24 @@ def parse_physical_path(physical_path):
             path = '/' + path
     return location, path
 
+# whether 'location' (name or ip:port) denotes this host
+def is_this_host(location):
+    return location in (config['ip'] + ':' + config['port'], config['name'])
+
 # 'path' is a logical path
 async def parent_path_exists(path):
-    cursor = await metaDB.cursor()
-    await cursor.execute('select count(*) from filesystem where logical_path = ?',
-                        (os.path.split(path)[0],))
-    if (await cursor.fetchone())[0] == 0:
-        return False
-    return True
+    return await path_exists(os.path.split(path)[0])
 
 async def path_exists(path):
-    cursor = await metaDB.cursor()
-    await cursor.execute('select count(*) from filesystem where logical_path = ?',
-                        (path,))
-    if (await cursor.fetchone())[0] == 0:
-        return False
-    return True
+    if logical_tree is not None:
+        return find_row(logical_tree, path) is not None
+    async with read_db() as db:
+        cursor = await db.cursor()
+        await cursor.execute('select 1 from filesystem where logical_path = ? limit 1',
+                            (path,))
+        result = await cursor.fetchone()
+        await cursor.close()
+    return result is not None
 
 # When initiate a physical root path for a new started daemon, 'dst' is None.
 # 'src' is like '//ip:port/local/path'.
@@ -308,10 +2325,14 @@ async def echo_ln(src, dst, host_name, writer, size=0):
             writer.write(b'E: 403 Path Already Exist\n\n')
             await writer.drain()
         else:
-            await cursor.execute(
-                'insert into filesystem values (?, ?, 2, ?, ?, ?, ?, ?)',
-                (dst, path, now, now, size, location, host_name)
+            await cursor.execute('''
+                insert into filesystem
+                (logical_path, physical_path, category, ctime, mtime, size, 
+                host_addr, host_name, logical_parent)
+                values (?, ?, 2, ?, ?, ?, ?, ?, ?)
+                ''', (dst, path, now, now, size, location, host_name, parent_of(dst))
             )
+            cache_add(dst, path, 2, now, now, size, location, host_name)
             logging.info('link %s to %s successfully' % (src, dst))
     else: # Record a single physical path with no logical path
         # Judge whether the path is dir by whether it ends with '/'
@@ -320,14 +2341,180 @@ async def echo_ln(src, dst, host_name, writer, size=0):
             path = path.rstrip('/')
         await cursor.execute('''
             insert into filesystem
-            (physical_path, category, ctime, mtime, size, host_addr, host_name)
-            values  (?, ?, ?, ?, ?, ?, ?)
-            ''', (path, is_file, now, now, size, location, host_name))
+            (physical_path, category, ctime, mtime, size, host_addr, host_name, 
+            physical_parent)
+            values  (?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (path, is_file, now, now, size, location, host_name, parent_of(path)))
+        cache_add(None, path, is_file, now, now, size, location, host_name)
         logging.info(f'update host {host_name!r}\'s path {path!r}')
 
     await cursor.close()
-    await metaDB.commit()
+    await commit_db()
+
+    writer.write(b'E: 200 OK\n\n')
+    await writer.drain()
+
+
+# insert records made by 'make_records' in one transaction
+async def insert_records(records, location, host_name):
+    global metaDB
+    rows = []
+    for record in records:
+        physical_path, logical_path, is_file, ctime, mtime, size = record[:6]
+        file_hash = record[6] if len(record) > 6 else None
+        if physical_path != '/':
+            physical_path = physical_path.rstrip('/')
+        if logical_path:
+            category, logical_parent, physical_parent = 2, parent_of(logical_path), None
+        else:
+            category, logical_parent, physical_parent = is_file, None, parent_of(physical_path)
+        rows.append((logical_path, physical_path, category, format_time(ctime), 
+                    format_time(mtime), size, location, host_name, 
+                    logical_parent, physical_parent, file_hash))
+    cursor = await metaDB.cursor()
+    await cursor.executemany('''
+        insert into filesystem
+        (logical_path, physical_path, category, ctime, mtime, size, host_addr, host_name,
+        logical_parent, physical_parent, hash)
+        values  (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', rows)
+    await cursor.close()
+    await commit_db()
+    for row in rows:
+        cache_add(*row[:8], row[10])
+    return len(rows)
+
+# Bulk registration of paths in a host.
+# 'src' is like '//ip:port', the content is a json list of records like
+# [physical_path, logical_path, is_file, ctime, mtime, size],
+# which are inserted in one transaction.
+async def echo_rg(src, host_name, reader, writer, size=0):
+    global metaDB
+    start = time.time()
+    location, _ = parse_physical_path(src)
+    try:
+        records = json.loads(await reader.readexactly(size))
+    except (asyncio.IncompleteReadError, ValueError):
+        writer.write(b'E: 400 Illegal Records\n\n')
+        await writer.drain()
+        return
+
+    count = await insert_records(records, location, host_name)
+
+    elapsed = time.time() - start
+    logging.info(f'register {count} paths of host {host_name!r} in {elapsed:.3f}s '
+                 f'({count / max(elapsed, 1e-6):.0f} records/s)')
+    writer.write(b'E: 200 OK\n\n')
+    await writer.drain()
+
+
+# 'src' is like '//ip:port', the content is a json map of its dirs to their 
+# digests, response with the dirs whose digests differ from what we have
+async def echo_dg(src, reader, writer, size=0):
+    location, _ = parse_physical_path(src)
+    try:
+        digests = json.loads(await reader.readexactly(size))
+    except (asyncio.IncompleteReadError, ValueError):
+        writer.write(b'E: 400 Illegal Digests\n\n')
+        await writer.drain()
+        return
+    tree = await host_tree(location)
+    known = tree is not None and tree.category is not None
+    response = {'known': known, 'differ': diff_digests(tree, digests) if known else []}
+    writer.write(b'E: 200 OK\n\n' + json.dumps(response).encode('utf-8'))
+    await writer.drain()
+
+# 'src' is like '//ip:port', the content is a json list of dirs' listings,
+# which are like [dir, record of dir, records of its children].
+async def echo_rs(src, host_name, reader, writer, size=0):
+    location, _ = parse_physical_path(src)
+    try:
+        listings = json.loads(await reader.readexactly(size))
+    except (asyncio.IncompleteReadError, ValueError):
+        writer.write(b'E: 400 Illegal Listings\n\n')
+        await writer.drain()
+        return
+    count = await replace_dirs(location, host_name, listings)
+    logging.info(f'rewrite {len(listings)} dirs ({count} paths) of host {host_name!r}')
+    writer.write(b'E: 200 OK\n\n')
+    await writer.drain()
+
+
+# apply deltas sent by a watcher (see 'Watcher') in one transaction
+# whether 'delta' is like ['d', physical_path] or ['a' or 'm', record]
+def is_delta(delta):
+    if not isinstance(delta, list) or len(delta) != 2:
+        return False
+    op, item = delta
+    if op == 'd':
+        return isinstance(item, str)
+    return op in ('a', 'm') and isinstance(item, list) and 6 <= len(item) <= 7 \
+        and isinstance(item[0], str)
+
+async def apply_deltas(host_addr, host_name, deltas):
+    global metaDB
+    cursor = await metaDB.cursor()
+    records = []
+    root = host_trees.get(host_addr) if logical_tree is not None else None
+    for op, item in deltas:
+        path = item[0] if op != 'd' else item
+        if op != 'd' and len(item) < 7 and item[2]:
+            # a file whose size and mtime don't change keeps its hash
+            await cursor.execute('''
+                select hash from filesystem
+                where host_addr = ? and logical_path is null and physical_path = ?
+                    and size = ? and mtime = ?
+                ''', (host_addr, path, item[5], format_time(item[4])))
+            row = await cursor.fetchone()
+            item = item + [row[0] if row else None]
+        await cursor.execute('''
+            delete from filesystem
+            where host_addr = ? and logical_path is null and physical_path = ?
+            ''', (host_addr, path))
+        if op == 'd':
+            await cursor.execute('''
+                delete from filesystem
+                where host_addr = ? and logical_path is null 
+                    and physical_path > ? and physical_path < ?
+                ''', (host_addr, path.rstrip('/') + '/', path.rstrip('/') + '0'))
+            node = find_node(root, path) if root else None
+            if node:
+                node.remove_tree()
+        else:
+            records.append(item)
+    await cursor.close()
+    return await insert_records(records, host_addr, host_name)
+
+# respond with the files whose content hash is 'file_hash',
+# like [{"name": physical_path, "host": ip_port}]
+async def echo_hs(file_hash, writer):
+    async with read_db() as db:
+        cursor = await db.cursor()
+        await cursor.execute('''
+            select physical_path, host_addr from filesystem
+            where hash = ? and logical_path is null
+            ''', (file_hash,))
+        rows = await cursor.fetchall()
+        await cursor.close()
+    file_list = [{'name': path, 'host': addr} for path, addr in rows
+                 if addr not in offline_addrs]
+    writer.write(b'E: 200 OK\n\n')
+    writer.write(json.dumps(file_list).encode('utf-8'))
+    await writer.drain()
 
+# 'src' is like '//ip:port', the content is a json list of deltas
+async def echo_up(src, host_name, reader, writer, size=0):
+    location, _ = parse_physical_path(src)
+    try:
+        deltas = json.loads(await reader.readexactly(size))
+        if not isinstance(deltas, list) or not all(map(is_delta, deltas)):
+            raise ValueError('Malformed delta')
+    except (asyncio.IncompleteReadError, ValueError):
+        writer.write(b'E: 400 Illegal Deltas\n\n')
+        await writer.drain()
+        return
+    await apply_deltas(location, host_name, deltas)
+    logging.info(f'update {len(deltas)} paths of host {host_name!r}')
     writer.write(b'E: 200 OK\n\n')
     await writer.drain()
 
@@ -335,68 +2522,67 @@ async def echo_ln(src, dst, host_name, writer, size=0):
 # dst is a logical path, like '/dir/a/file', 
 # or a physical path, like '//137.0.0.1/local/path'
 #                      or  '//h2/local/path'
-async def echo_ls(dst, writer):
-    global metaDB
-    cursor = await metaDB.cursor()
+# the same as 'cache_ls', but from database
+async def db_ls(db, dst, after=None, limit=None):
+    cursor = await db.cursor()
     file_list = []
     
     if dst == '//': # fetch all hosts' info
         await cursor.execute('''select distinct host_name, host_addr from filesystem
-                        where host_name is not null and host_addr is not null''')
+                        where host_name is not null and host_addr is not null
+                        order by host_name''')
         results = await cursor.fetchall()
-        if len(results) == 0: # should never happen
-            writer.write(b'E: 500 No Host Detected\n\n')
-            await writer.drain()
-            return
+        await cursor.close()
         for record in results:
+            if record[1] in offline_addrs:
+                continue
             item = {'name': record[0], 'addr': record[1]}
             file_list.append(item)
-    elif dst.startswith('//'): # physical path
+        return file_list or None, None
+
+    if dst.startswith('//'): # physical path
         dst = dst.rstrip('/')
         location, path = parse_physical_path(dst)
         if location.find('.') != -1: # if location denotes an 'ip:port'
-            await cursor.execute('''
-                select * from filesystem 
-                where host_addr like ? and physical_path like ?
-                    and not physical_path like ?
-                order by physical_path asc
-            ''', (location, path + '%%', path + '_%%/%%'))
+            column = 'host_addr'
         else: # if location denotes an name
-            await cursor.execute('''
-                select * from filesystem 
-                where host_name = ? and physical_path like ?
-                    and not physical_path like ?
-                order by physical_path asc
-            ''', (location, path + '%%', path + '_%%/%%'))
-            
-        results = await cursor.fetchall()
-        if len(results) == 0:
-            writer.write(b'E: 404 Path Not Found\n\n')
-            await writer.drain()
-            return
-        for record in results:
-            item = {
+            column = 'host_name'
+        # the path itself
+        self_query = f'''
+            select * from filesystem 
+            where {column} = ? and physical_path = ? and logical_path is null
+            '''
+        # and its children in order, the index on (column, physical_parent, 
+        # physical_path) makes each page cost only its own rows
+        children_query = f'''
+            select * from filesystem
+            where {column} = ? and physical_parent = ? and physical_path > ?
+            order by physical_path asc limit ?
+            '''
+        args = (location, path)
+        def make_item(record):
+            return {
                 'name' : record[1],
                 'type' : 'f' if record[2] else 'd',
                 'ctime': record[3],
                 'mtime': record[4],
                 'size' : record[5],
-                'host' : record[6]  # ip and port
+                'host' : record[6], # ip and port
+                'hash' : record[10]
             }
-            file_list.append(item)
     else: # logical path
-        await cursor.execute('''
-                select * from filesystem 
-                where logical_path like ? and not logical_path like ?
-                order by logical_path asc
-                ''', (dst + '%%', dst + '_%%/%%'))
-        results = await cursor.fetchall()
-        if len(results) == 0:
-            writer.write(b'E: 404 Path Not Found\n\n')
-            await writer.drain()
-            return
-        for record in results:
-            item = {
+        if dst != '/':
+            dst = dst.rstrip('/')
+        path = dst
+        self_query = 'select * from filesystem where logical_path = ?'
+        children_query = '''
+            select * from filesystem 
+            where logical_parent = ? and logical_path > ?
+            order by logical_path asc limit ?
+            '''
+        args = (dst,)
+        def make_item(record):
+            return {
                 'name' : record[0],
                 'type' : record[1], # the physical path for this logical path
                 'ctime': record[3],
@@ -404,9 +2590,89 @@ async def echo_ls(dst, writer):
                 'size' : record[5],
                 'host' : record[6]  # ip and port
             }
-            file_list.append(item)
+
+    results = []
+    if after is None:
+        await cursor.execute(self_query, args)
+        results += await cursor.fetchall()
+    # fetch one more child to know if there is a next page
+    remaining = -1 if limit is None else max(limit - len(results), 0)
+    lower = '' if after is None else path.rstrip('/') + '/' + after
+    await cursor.execute(children_query, 
+                         args + (lower, -1 if limit is None else remaining + 1))
+    children = await cursor.fetchall()
     await cursor.close()
-    await metaDB.commit()
+    next_name = None
+    if limit is not None and len(children) > remaining:
+        children = children[:remaining]
+        last = children[-1] if children else None
+        if last:
+            next_name = (last[1] if dst.startswith('//') else last[0]).rsplit('/', 1)[1]
+        else:
+            next_name = '' if after is None else after
+    results = [record for record in results + children if record[6] not in offline_addrs]
+    if not results and after is None:
+        return None, None
+    return [make_item(record) for record in results], next_name
+
+
+# the resume token of 'ls' to list entries after the child named 'name'
+def make_token(name):
+    return ('/' + name).encode('utf-8').hex()
+
+def parse_token(token):
+    return bytes.fromhex(token).decode('utf-8')[1:]
+
+# Respond with the entries of 'dst' (see 'cache_ls'). If 'limit' is given, 
+# respond with a page of them like {"entries": [...], "next": token}, where
+# 'token' is used in the 'O' field of next 'ls' to get next page.
+# A shell asking for a lease by 'U: seconds' gets 'lease' in the page, see
+# 'Resolution Cache'.
+# In 'ndjson' mode, all entries after 'after' are streamed in frames like
+# 'L: length\nO: token\n\n' followed by 'limit' entries, one json per line,
+# and a frame 'L: 0\n\n' at last. A broken stream is resumed by 'O'.
+async def echo_ls(dst, writer, after=None, limit=None, mode=None, lease=None):
+    async def list_page(after):
+        if logical_tree is not None: # served by namespace cache
+            return cache_ls(dst, after, limit)
+        async with read_db() as db:
+            return await db_ls(db, dst, after, limit)
+
+    start = time.perf_counter()
+    file_list, next_name = await list_page(after)
+    logging.debug(f'ls {dst!r} in {(time.perf_counter() - start) * 1e6:.0f}us')
+    if file_list is None:
+        if dst == '//': # should never happen
+            writer.write(b'E: 500 No Host Detected\n\n')
+        else:
+            writer.write(b'E: 404 Path Not Found\n\n')
+        await writer.drain()
+        return
+    if mode == 'ndjson':
+        if isinstance(writer, FrameWriter): # send each page once it is listed
+            writer.streaming = True
+        writer.write(b'E: 200 OK\n\n')
+        while True:
+            content = ''.join(json.dumps(item) + '\n' for item in file_list)
+            content = content.encode('utf-8')
+            header = f'L: {len(content)}\n'
+            if next_name is not None:
+                header += f'O: {make_token(next_name)}\n'
+            writer.write(header.encode('utf-8') + b'\n' + content)
+            await writer.drain()
+            if next_name is None:
+                break
+            file_list, next_name = await list_page(next_name)
+            if file_list is None: # 'dst' is gone
+                break
+        writer.write(b'L: 0\n\n')
+        await writer.drain()
+        return
+    if limit is not None:
+        next_token = make_token(next_name) if next_name is not None else None
+        file_list = {'entries': file_list, 'next': next_token}
+        if lease: # the page may be cached by a shell for so many seconds
+            file_list['lease'] = min(lease, config.get('lease', LEASE))
     data = b'E: 200 OK\n\n' + json.dumps(file_list).encode('utf-8')
     logging.debug(data)
     writer.write(data) # need to add 'L' field in header?
@@ -430,11 +2696,12 @@ async def echo_md(dst, writer):
         now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         await cursor.execute('''
             insert into filesystem
-            (logical_path, category, ctime, mtime, size)
-            values (?, 2, ?, ?, 0)
-            ''', (dst, now, now)
+            (logical_path, category, ctime, mtime, size, logical_parent)
+            values (?, 2, ?, ?, 0, ?)
+            ''', (dst, now, now, parent_of(dst))
         )
-        await metaDB.commit()
+        cache_add(dst, None, 2, now, now, 0, None, None)
+        await commit_db()
         writer.write(b'E: 200 OK\n\n')
         await writer.drain()
     await cursor.close()
@@ -450,25 +2717,33 @@ async def echo_rm(dst, writer):
 
     dst.rstrip('/')
     if dst[1] != '/': # logical path
-        await cursor.execute('select physical_path from filesystem where logical_path = ?',
-                        (dst,))
-        result = await cursor.fetchone()
+        if logical_tree is not None:
+            node = find_row(logical_tree, dst)
+            result = (node.target,) if node else None
+        else:
+            await cursor.execute('select physical_path from filesystem where logical_path = ?',
+                            (dst,))
+            result = await cursor.fetchone()
         if not result:
             writer.write(b'E: 404 Path Not Found\n\n')
             await writer.drain()
             return
         physical_path = result[0]
         if not physical_path or not physical_path.startswith('/'):
+            # paths under 'dst' are between 'dst/' and 'dst0' ('0' follows '/')
             await cursor.execute('''
                     delete from filesystem 
-                    where logical_path like ? or logical_path = ?
-                    ''', (dst + '/%%', dst))
+                    where logical_path = ? or (logical_path > ? and logical_path < ?)
+                    ''', (dst, dst + '/', dst + '0'))
+            cache_remove_logical(dst)
             logging.info('delete logical path \'%s\''% dst)
         else:
             await cursor.execute('''
-                update filesystem set logical_path = null
+                update filesystem set logical_path = null, logical_parent = null, 
+                    physical_parent = ?
                 where logical_path = ? 
-            ''', (dst,))
+            ''', (parent_of(physical_path), dst))
+            cache_disconnect(dst)
             logging.info('disconnect logical path \'%s\' with its physical path' % dst)
     else: # physical path
         location, dst_path = parse_physical_path(dst)
@@ -482,9 +2757,10 @@ async def echo_rm(dst, writer):
                     delete from filesystem 
                     where physical_path = ? and host_addr = ?
                 ''', (dst_path, location))
+        cache_remove_physical(location, dst_path)
         logging.info(f'delete a physical path {dst_path!r} from {location!r}')
     
-    await metaDB.commit()
+    await commit_db()
     await cursor.close()
     writer.write(b'E: 200 OK\n\n')
     await writer.drain()
@@ -494,74 +2770,323 @@ async def echo_rm(dst, writer):
 # Either src or dst must be this host, like '//127.0.0.1:8080/path'
 # which determine whether this host sends or receives a file
 # support only single file transfer
-async def echo_cp(src, dst, reader, writer, size=0):
+# 'offset' and 'total' are set when a range of the file is copied
+# 'file_hash' is the content hash of the file, if the sender knows it
+# 'pack' is set when a dir is copied in packs, see 'Directory Copy'
+# Return True if this host has sent the file successfully.
+async def echo_cp(src, dst, reader, writer, size=0, offset=None, total=None, 
+                  file_hash=None, pack=None, codec=None):
     src_addr, src_path = parse_physical_path(src)
     dst_addr, dst_path = parse_physical_path(dst)
     
-    if src_addr.split(':')[0] == config['ip']: # this is sending side
+    if is_this_host(src_addr) and is_this_host(dst_addr): # a copy in this host
+        src_path = config['root'] + src_path
+        dst_path = config['root'] + dst_path
+        if os.path.exists(dst_path):
+            writer.write(b'E: 403 File Already Exists\n\n')
+        elif not os.path.isfile(src_path) or not file_hash:
+            writer.write(b'E: 404 File Not Found\n\n')
+        elif not await copy_local(src_path, dst_path, file_hash):
+            writer.write(b'E: 409 Content Changed\n\n')
+        else:
+            writer.write(b'E: 200 OK\n\n')
+            logging.info(f'Copy {src_path!r} to {dst_path!r} locally')
+            await register_file(dst_path)
+        await writer.drain()
+
+    elif is_this_host(src_addr): # this is sending side
         if src_path.find(':') == -1:  # the file may be in root directory
             src_path = config['root'] + src_path
-        if os.path.isfile(src_path):  # also return false if path doesn't exist
+        codec = pick_codec(codec) # 'codec' is what the receiver offers
+        if pack is not None and os.path.isdir(src_path):
+            await send_packs(src_path.rstrip('/'), writer, codec)
+            return True
+        if not os.path.isfile(src_path):  # also return false if path doesn't exist
+            writer.write(b'E: 404 File Not Found\n\n')
+            await writer.drain()
+        elif offset is None:
             loop = asyncio.get_running_loop()
+            file_hash = await hash_file(src_path)
             # 'dst_path' is not important here, as we send file through 'tr'
-            await send_file(src_path, dst_path, writer, loop)
+            await send_file(src_path, dst_path, writer, loop, file_hash, codec)
             if await get_error(reader, writer):
                 return
             logging.info('Send file successfully!')
-        else:
-            writer.write(b'E: 404 File Not Found\n\n')
+            if src_path.startswith(config['root'] + '/'):
+                await register_file(src_path)  # let tracker know its hash
+            return True
+        elif offset < 0 or size <= 0 or offset + size > os.path.getsize(src_path):
+            writer.write(b'E: 416 Range Not Satisfiable\n\n')
             await writer.drain()
+        else:
+            file_hash = await hash_file(src_path)
+            await send_range(src_path, dst_path, offset, size, writer, file_hash, codec)
+            if await get_error(reader, writer):
+                return
+            logging.info(f'Send range {offset}-{offset + size} of {src_path!r}')
+            return True
 
-    elif dst_addr.split(':')[0] == config['ip']: # this is receiving side
+    elif is_this_host(dst_addr): # this is receiving side
         # allow only copying to root directory
         dst_path = config['root'] + dst_path
-        if not os.path.exists(dst_path):  # if we are not covering a existing file
-             with open(dst_path, 'wb') as f:
-                if size > 0:
-                    origin_size = size
-                    while size >= 4096:
-                        f.write(await reader.read(4096))
-                        size -= 4096
-                    f.write(await reader.read(size))
-                    writer.write(b'E: 200 OK\n\n')
-                    await writer.drain()
-                    # record new copied file in db
-                    if config['istracker']:
-                        cursor = await metaDB.cursor()
-                        now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                        path = root_to_relative(dst_path)
-                        await cursor.execute('''
-                            insert into filesystem
-                            (physical_path, category, ctime, mtime, size, host_addr, host_name)
-                            values  (?, 1, ?, ?, ?, ?, ?)
-                            ''', 
-                            (path, now, now, origin_size, 
-                            config['ip'] + ':' + config['port'], config['name'])
-                        )
-                        await metaDB.commit()
-                        await cursor.close()
-                        logging.info('update host %s\'s path %s' % (config['name'], path))
-                    else:
-                        await load_path(dst_path, is_tracker=False)
-                else:
-                    writer.write(b'E: 400 No Length Field\n\n')
-                    await writer.drain()
-        else: 
+        if codec is not None and codec not in CODECS:
+            writer.write(b'E: 415 Unsupported Compression\n\n')
+            await writer.drain()
+            writer.close()  # the content is not read, so drop the connection
+        elif pack is not None: # a pack of files in a dir
+            await receive_pack(dst_path, reader, writer, size, file_hash, codec)
+        elif os.path.exists(dst_path):  # if we are covering a existing file
             writer.write(b'E: 403 File Already Exists\n\n')
             await writer.drain()
+            if offset is not None: # the range is not read, so drop the connection
+                writer.close()
+        elif size <= 0:
+            writer.write(b'E: 400 No Length Field\n\n')
+            await writer.drain()
+        elif offset is None:
+            try:
+                received_hash = await receive_file(reader, dst_path, size, codec)
+            except asyncio.IncompleteReadError:
+                logging.warning(f'Connection lost while receiving {dst_path!r}')
+                os.remove(dst_path)
+                return
+            except ValueError as e:
+                logging.warning(f'Fail to receive {dst_path!r}: {e}')
+                os.remove(dst_path)
+                writer.write(b'E: 400 Illegal Content\n\n')
+                await writer.drain()
+                return
+            if file_hash and received_hash != file_hash:
+                logging.warning(f'{dst_path!r} is received with a wrong hash')
+                os.remove(dst_path)
+                writer.write(b'E: 422 Hash Mismatch\n\n')
+                await writer.drain()
+                return
+            writer.write(b'E: 200 OK\n\n')
+            await writer.drain()
+            await register_file(dst_path)
+        elif total is None or offset < 0 or offset + size > total:
+            writer.write(b'E: 416 Range Not Satisfiable\n\n')
+            await writer.drain()
+            writer.close()  # the range is not read, so drop the connection
+        else:
+            try:
+                is_last = await receive_range(dst_path, src, offset, size, total, 
+                                              reader, file_hash, codec)
+            except ValueError as e:
+                logging.warning(f'{e}')
+                writer.write(b'E: 422 Hash Mismatch\n\n')
+                await writer.drain()
+                writer.close()  # a broken compressed range may be read partly
+                return
+            writer.write(b'E: 200 OK\n\n')
+            await writer.drain()
+            if is_last:
+                logging.info(f'Receive file {dst_path!r} successfully')
+                await register_file(dst_path)
+
+
+# receive a pack of 'size' bytes into local dir 'path', see 'Directory Copy'
+async def receive_pack(path, reader, writer, size, pack_hash, codec=None):
+    loop = asyncio.get_running_loop()
+    try:
+        data = await read_data(reader, size, codec)
+        count = await loop.run_in_executor(None, extract_pack, data, path, pack_hash)
+    except (tarfile.TarError, ValueError, OSError) as e:
+        logging.warning(f'Fail to unpack into {path!r}: {e!r}')
+        writer.write(b'E: 400 Illegal Pack\n\n')
+        await writer.drain()
+        return
+    logging.info(f'Unpack {count} paths into {path!r}')
+    writer.write(b'E: 200 OK\n\n')
+    await writer.drain()
+
+
+# 'dst' is like '//ip:port/path', register it and everything under it again
+async def echo_sc(dst, writer):
+    path = config['root'] + parse_physical_path(dst)[1]
+    if not os.path.exists(path):
+        writer.write(b'E: 404 Path Not Found\n\n')
+        await writer.drain()
+        return
+    await register_tree_again(path.rstrip('/'))
+    writer.write(b'E: 200 OK\n\n')
+    await writer.drain()
+
+
+# record a file in root with its hash in tracker
+async def register_file(path):
+    stat = os.stat(path)
+    key = (stat.st_size, stat.st_mtime_ns)
+    if registered_files.get(path) == key: # tracker has got its hash
+        return
+    record = path_record(path, stat) + [await hash_file(path)]
+    await send_deltas([['a', record]])
+    if len(registered_files) >= HASH_CACHE:
+        registered_files.clear()
+    registered_files[path] = key
+
+
+# 'dst' is like '//ip:port/path', respond with its journal (see 'load_journal')
+# so that the sender knows which ranges are still needed
+async def echo_pt(dst, writer):
+    dst_path = config['root'] + parse_physical_path(dst)[1]
+    if os.path.exists(dst_path):
+        writer.write(b'E: 403 File Already Exists\n\n')
+        await writer.drain()
+        return
+    writer.write(b'E: 200 OK\n\n')
+    writer.write(json.dumps(load_journal(dst_path)).encode('utf-8'))
+    await writer.drain()
+
+
+# Push 'src' ('//ip:port/path' in this host) to 'dst' in another host for a
+# shell, and tell it the progress, see 'Third-party Copy'
+async def echo_push(src, dst, writer, delete_src=False):
+    src_path = config['root'] + parse_physical_path(src)[1]
+    if not in_root(src_path):
+        writer.write(b'E: 403 Out Of Root\n\n')
+        await writer.drain()
+        return
+    if not os.path.exists(src_path):
+        writer.write(b'E: 404 File Not Found\n\n')
+        await writer.drain()
+        return
+    progress = Progress()
+    task = asyncio.create_task(push_path(src_path, dst, delete_src, progress))
+    try:
+        while not (await asyncio.wait([task], timeout=PROGRESS_INTERVAL))[0]:
+            writer.write(f'S: {progress.done} {progress.total}\n\n'.encode('utf-8'))
+            await writer.drain()
+    except ConnectionError:
+        logging.warning(f'Shell is gone, keep copying {src_path!r} to {dst!r}')
+    try:
+        is_done = await task
+    except (OSError, asyncio.IncompleteReadError) as e:
+        logging.warning(f'Fail to push {src_path!r} to {dst!r}: {e!r}')
+        is_done = False
+    if is_done:
+        logging.info(f'Push {src_path!r} to {dst!r} successfully')
+        writer.write(b'E: 200 OK\n\n')
+    else:
+        writer.write(b'E: 502 Copy Failed\n\n')
+    await writer.drain()
+
+
+# 'src' is like '//ip:port' of the daemon sending heartbeat, which knows the
+# 'version' of membership, and has started at 'generation'. Respond with the
+# version, and the living hosts if they have changed since that version.
+# A daemon that tracker may have missed changes of is asked to resync.
+async def echo_hb(src, version, generation, host_name, writer):
+    global members_version
+    location, _ = parse_physical_path(src)
+    daemon = daemons.get(host_name)
+    if daemon is not None and daemon['state'] == 'alive':
+        observe('heartbeat_gap_seconds', time.time() - daemon['seen'])
+    response = {}
+    if daemon is None or daemon['state'] != 'alive' or daemon['addr'] != location:
+        if daemon and daemon['generation'] in (None, generation):
+            # it's been cut off, or tracker has restarted, rather than itself
+            response['resync'] = True
+        if daemon and daemon['addr'] != location:
+            # what's recorded under its old address is out of date
+            offline_addrs.add(daemon['addr'])
+        offline_addrs.discard(location)
+        members[host_name] = location
+        members_version += 1
+        logging.info(f'Host {host_name!r} is alive, membership version {members_version}')
+    daemons[host_name] = {'seen': time.time(), 'state': 'alive', 
+                          'generation': generation, 'addr': location}
+    response['version'] = members_version
+    if version != members_version:
+        response['hosts'] = [
+            {'name': name, 'addr': addr, 
+             'state': daemons[name]['state'] if name in daemons else 'alive'} 
+            for name, addr in members.items()]
+    writer.write(b'E: 200 OK\n\n')
+    writer.write(json.dumps(response).encode('utf-8'))
+    await writer.drain()
+
+
+# respond with the routing table of trackers, see 'Sharded Trackers'
+async def echo_rt(writer):
+    writer.write(b'E: 200 OK\n\n')
+    writer.write(json.dumps(await get_routes()).encode('utf-8'))
+    await writer.drain()
+
+async def echo_misdirected(writer):
+    writer.write(b'E: 421 Misdirected Request\n\n')
+    await writer.drain()
+
+
+# respond with the version of membership, and the offline hosts if that's
+# newer than 'version' known by a worker, see 'Tracker Workers'
+async def echo_ms(version, writer):
+    response = {'version': members_version}
+    if version != members_version:
+        response['offline'] = sorted(offline_addrs)
+    writer.write(b'E: 200 OK\n\n')
+    writer.write(json.dumps(response).encode('utf-8'))
+    await writer.drain()
+
+
+# respond with the metrics of this daemon, see 'Metrics'
+async def echo_mt(writer):
+    writer.write(b'E: 200 OK\n\n')
+    writer.write(json.dumps(metrics_json()).encode('utf-8'))
+    await writer.drain()
+
+
+# respond with what this daemon supports, ie. codecs for 'Z'
+async def echo_ca(writer):
+    writer.write(b'E: 200 OK\n\n')
+    writer.write(json.dumps({'compress': list(CODECS)}).encode('utf-8'))
+    await writer.drain()
 
 
 # This must be the sending side
 # src is like '//hostsock/path'
-async def echo_mv(src, dst, reader, writer, size=0):
+# If the file was copied in ranges by 'cp', 'offset' is the size of the 
+# file, and the file is just removed.
+# If a dir was copied in packs by 'cp', 'pack' is set, and the dir is removed
+# once tracker knows 'dst' ('//ip:port/path') as a dir.
+async def echo_mv(src, dst, reader, writer, size=0, offset=None, pack=None, codec=None):
     src_addr, relative_path = parse_physical_path(src)
     src_path = config['root'] + relative_path
     # allow only moving from root directory
+    if not in_root(src_path):
+        writer.write(b'E: 403 Out Of Root\n\n')
+        await writer.drain()
+        return
     if not os.path.exists(src_path):
         writer.write(b'E: 404 File Not Found\n\n')
         await writer.drain()
         return
-    await echo_cp(src, dst, reader, writer, size)
+    if os.path.isdir(src_path):
+        if pack is None:
+            writer.write(b'E: 400 Not A File\n\n')
+            await writer.drain()
+            return
+        if not await dir_registered(dst):
+            writer.write(b'E: 409 Copy Not Confirmed\n\n')
+            await writer.drain()
+            return
+        writer.write(b'E: 200 OK\n\n')
+        await writer.drain()
+        await asyncio.get_running_loop().run_in_executor(None, shutil.rmtree, src_path)
+        await send_deltas([['d', relative_path.rstrip('/')]])
+        logging.info(f'Remove {src_path!r}.')
+        return
+    if offset is None:
+        if not await echo_cp(src, dst, reader, writer, size, codec=codec):
+            return
+    elif offset != os.path.getsize(src_path):
+        writer.write(b'E: 416 Range Not Satisfiable\n\n')
+        await writer.drain()
+        return
+    else:
+        writer.write(b'E: 200 OK\n\n')
+        await writer.drain()
     os.remove(src_path)
     if config['istracker']:
         cursor = await metaDB.cursor()
@@ -569,7 +3094,8 @@ async def echo_mv(src, dst, reader, writer, size=0):
             delete from filesystem 
             where physical_path = ? and host_addr = ?
         ''', (relative_path, src_addr))
-        await metaDB.commit()
+        await commit_db()
+        cache_remove_physical(src_addr, relative_path)
         await cursor.close()
         logging.info(f'delete a physical path {relative_path!r} from {src_addr!r}')
     else:
@@ -577,6 +3103,26 @@ async def echo_mv(src, dst, reader, writer, size=0):
     logging.info(f'Remove {src_path!r}.')
 
 
+# whether local path 'path' is inside root (but not root itself), 
+# after following links and '..'
+def in_root(path):
+    root = os.path.realpath(config['root'])
+    return os.path.realpath(path).startswith(root + os.sep)
+
+# whether tracker knows physical path 'path' ('//ip:port/path') as a dir
+async def dir_registered(path):
+    if not path.startswith('//'):
+        return False
+    try:
+        err_msg, data = await shard_request(path, ['ls', path], fields={'N': 1})
+    except ConnectionError:
+        return False
+    if err_msg.split(' ', 2)[1] != '200':
+        return False
+    entries = json.loads(data)['entries']
+    return bool(entries) and entries[0].get('type') == 'd'
+
+
 async def echo_illegal_command(writer):
     logging.warning('Reciive illegal command')
     writer.write(b'E: 400 Illegal Command\n\n')
@@ -584,9 +3130,101 @@ async def echo_illegal_command(writer):
 
 
 async def echo_request(reader, writer):
-    data = await reader.readuntil(b'\n\n')
-    header = parse_header(data.decode('utf-8'))
+    pending = set() # multiplexed requests being handled
+    binary = False  # whether the connection is upgraded to binary frames
+    while True:
+        if binary:
+            try:
+                header, content = await read_request_frame(reader)
+            except (asyncio.IncompleteReadError, ConnectionError):
+                break
+            except ValueError as e:
+                logging.warning(f'Receive illegal frame: {e!r}')
+                break
+            body = asyncio.StreamReader()
+            body.feed_data(content)
+            body.feed_eof()
+            task = asyncio.create_task(
+                handle_frame(header, body, FrameWriter(writer, header['I'], binary=True)))
+            pending.add(task)
+            task.add_done_callback(pending.discard)
+            continue
+        try:
+            data = await reader.readuntil(b'\n\n')
+        except (asyncio.IncompleteReadError, ConnectionError):
+            break # peer closed the connection
+        header = parse_header(data.decode('utf-8'))
+        if not 'I' in header: # serve exactly one request on this connection
+            await handle_request(header, reader, writer)
+            # but ranges of a file, or packs of a dir are copied one after another
+            if not ('R' in header or 'P' in header) or writer.is_closing():
+                break
+            continue
+        # read the content here, as the following bytes belong to next request
+        body = asyncio.StreamReader()
+        if split_command(header.get('C', ''))[0] in BODY_COMMANDS and 'L' in header:
+            try:
+                body.feed_data(await reader.readexactly(int(header['L'])))
+            except (asyncio.IncompleteReadError, ConnectionError):
+                break
+        body.feed_eof()
+        # the peer asks to switch to binary frames after this request
+        fields = {}
+        if header.get('V', '').endswith(' ' + WIRE_NAME) and config.get('binary', True):
+            fields['V'] = WIRE_NAME
+            binary = True
+        # the response is sent as a frame, while we keep reading next requests
+        task = asyncio.create_task(
+            handle_frame(header, body, FrameWriter(writer, header['I'], fields=fields)))
+        pending.add(task)
+        task.add_done_callback(pending.discard)
+    if pending:
+        await asyncio.wait(pending)
+
+
+async def handle_frame(header, reader, writer):
+    try:
+        if split_command(header.get('C', ''))[0] in FRAME_COMMANDS:
+            await handle_request(header, reader, writer)
+        else:
+            await echo_illegal_command(writer)
+    except Exception as e:
+        # the peer waits for a response to this request anyway
+        logging.exception(f'Fail to handle {header.get("C")!r}: {e!r}')
+        # a response partly sent is cut short, the last frame ends it
+        writer.buffer = [] if writer.started else [b'E: 500 Internal Error\n\n']
+    try:
+        await writer.flush()
+    except ConnectionError:
+        logging.warning('Connection lost before sending response')
 
+
+# handle a request and record its metrics
+async def handle_request(header, reader, writer):
+    cmd = split_command(header.get('C', ''))[0]
+    if cmd not in METRIC_COMMANDS:
+        cmd = 'illegal'
+    in_flight[cmd] = in_flight.get(cmd, 0) + 1
+    spent = [0.0]
+    token = db_time.set(spent)
+    start = time.perf_counter()
+    try:
+        await dispatch_request(header, reader, writer)
+    finally:
+        elapsed = time.perf_counter() - start
+        db_time.reset(token)
+        in_flight[cmd] -= 1
+        count('requests', cmd=cmd)
+        observe('request_seconds', elapsed, cmd)
+        if metaDB is not None or meta_readers is not None:
+            observe('db_seconds', spent[0], cmd)
+        slow = config.get('slow_request')
+        if slow is not None and elapsed > slow:
+            logging.warning(f'Slow request {header.get("C")!r} from '
+                            f'{header.get("V", "").split(" ")[0]!r}: {elapsed:.3f}s, '
+                            f'{spent[0]:.3f}s in database')
+
+async def dispatch_request(header, reader, writer):
     # check required fields
     if not 'V' in header:
         writer.write(b'E: 400 No Version Field\n\n')
@@ -602,65 +3240,147 @@ async def echo_request(reader, writer):
         return
 
     # check authorization
-    sha1 = hashlib.sha1()
-    sha1.update(config['secret'].encode('utf-8'))
-    sha1.update(header['C'].encode('utf-8'))
-    if sha1.hexdigest() != header['A']: # wrong password
+    if authorize(header['C']) != header['A']: # wrong password
         writer.write(b'E: 401 Unauthorized\n\n')
         await writer.drain()
         return
 
     host_name, ver = header['V'].split(' ', 1)
-    # If we receive a host's heartbeat, update 'daemons'
-    if ver == 'HB':
-        now = time.time()
-        daemons[host_name] = now
-        logging.info(f'Update {host_name!r}\'s timestamp: {now!r}')
-        
+
 
     # handle authorized request
-    cmd = header['C'].split(' ')
+    cmd = split_command(header['C'])
+    if owner_addr is not None and cmd[0] not in WORKER_COMMANDS:
+        if 'I' in header:
+            await forward_request(header, reader, writer)
+        else:
+            await splice_to_owner(header, reader, writer)
+        return
     if cmd[0] == 'ln':
         if len(cmd) < 2:
             await echo_illegal_command(writer)
             return
         elif len(cmd) == 2: # if we are link just a physical path
             cmd.append(None)
+        if cmd[2] and misdirected(cmd[2]):
+            await echo_misdirected(writer)
+            return
         if 'L' in header:
             await echo_ln(cmd[1], cmd[2], host_name, writer, int(header['L']))
         else:
             await echo_ln(cmd[1], cmd[2], host_name, writer)
+    elif cmd[0] == 'rg':
+        if len(cmd) < 2 or not 'L' in header:
+            await echo_illegal_command(writer)
+            return
+        await echo_rg(cmd[1], host_name, reader, writer, int(header['L']))
+    elif cmd[0] == 'dg':
+        if len(cmd) < 2 or not 'L' in header:
+            await echo_illegal_command(writer)
+            return
+        await echo_dg(cmd[1], reader, writer, int(header['L']))
+    elif cmd[0] == 'rs':
+        if len(cmd) < 2 or not 'L' in header:
+            await echo_illegal_command(writer)
+            return
+        await echo_rs(cmd[1], host_name, reader, writer, int(header['L']))
+    elif cmd[0] == 'up':
+        if len(cmd) < 2 or not 'L' in header:
+            await echo_illegal_command(writer)
+            return
+        await echo_up(cmd[1], host_name, reader, writer, int(header['L']))
     elif cmd[0] == 'ls':
         if len(cmd) < 2:
             await echo_illegal_command(writer)
             return
-        await echo_ls(cmd[1], writer)
+        try:
+            after = parse_token(header['O']) if 'O' in header else None
+            limit = int(header['N']) if 'N' in header else None
+            if limit is not None and limit < 1:
+                raise ValueError(f'Illegal page size {limit}')
+        except ValueError:
+            writer.write(b'E: 400 Illegal Page\n\n')
+            await writer.drain()
+            return
+        if misdirected(cmd[1]):
+            await echo_misdirected(writer)
+            return
+        try:
+            lease = int(header['U']) if 'U' in header else None
+        except ValueError:
+            writer.write(b'E: 400 Illegal Lease\n\n')
+            await writer.drain()
+            return
+        await echo_ls(cmd[1], writer, after, limit, header.get('M'), lease)
     elif cmd[0] == 'md':
         if len(cmd) < 2:
             await echo_illegal_command(writer)
             return
+        if misdirected(cmd[1]):
+            await echo_misdirected(writer)
+            return
         await echo_md(cmd[1], writer)
     elif cmd[0] == 'rm':
         if len(cmd) < 2:
             await echo_illegal_command(writer)
             return
+        if misdirected(cmd[1]):
+            await echo_misdirected(writer)
+            return
         await echo_rm(cmd[1], writer)
+    elif cmd[0] == 'sc':
+        if len(cmd) < 2:
+            await echo_illegal_command(writer)
+            return
+        await echo_sc(cmd[1], writer)
+    elif cmd[0] == 'hs':
+        if len(cmd) < 2:
+            await echo_illegal_command(writer)
+            return
+        await echo_hs(cmd[1], writer)
+    elif cmd[0] == 'hb':
+        if len(cmd) < 4:
+            await echo_illegal_command(writer)
+            return
+        await echo_hb(cmd[1], int(cmd[2]), int(cmd[3]), host_name, writer)
+    elif cmd[0] == 'ca':
+        await echo_ca(writer)
+    elif cmd[0] == 'rt':
+        await echo_rt(writer)
+    elif cmd[0] == 'mt':
+        await echo_mt(writer)
+    elif cmd[0] == 'ms':
+        if len(cmd) < 2:
+            await echo_illegal_command(writer)
+            return
+        await echo_ms(int(cmd[1]), writer)
+    elif cmd[0] == 'pt':
+        if len(cmd) < 2:
+            await echo_illegal_command(writer)
+            return
+        await echo_pt(cmd[1], writer)
+    elif cmd[0] in ('cp', 'mv') and header.get('D') == 'push':
+        if len(cmd) < 3:
+            await echo_illegal_command(writer)
+            return
+        await echo_push(cmd[1], cmd[2], writer, delete_src=cmd[0] == 'mv')
     elif cmd[0] == 'cp':
         if len(cmd) < 3:
             await echo_illegal_command(writer)
             return
-        if 'L' in header:
-            await echo_cp(cmd[1], cmd[2], reader, writer, int(header['L']))
-        else:
-            await echo_cp(cmd[1], cmd[2], reader, writer)
+        size = int(header.get('L', 0))
+        offset = int(header['R']) if 'R' in header else None # a range of the file
+        total = int(header['T']) if 'T' in header else None
+        await echo_cp(cmd[1], cmd[2], reader, writer, size, offset, total, 
+                      header.get('H'), header.get('P'), header.get('Z'))
     elif cmd[0] == 'mv':
         if len(cmd) < 3:
             await echo_illegal_command(writer)
             return
-        if 'L' in header:
-            await echo_mv(cmd[1], cmd[2], reader, writer, int(header['L']))
-        else:
-            await echo_mv(cmd[1], cmd[2], reader, writer)
+        size = int(header.get('L', 0))
+        offset = int(header['R']) if 'R' in header else None
+        await echo_mv(cmd[1], cmd[2], reader, writer, size, offset, header.get('P'),
+                      header.get('Z'))
     else:
         await echo_illegal_command(writer)
         return
@@ -668,58 +3388,338 @@ async def echo_request(reader, writer):
     logging.info('Continue serving...')
 
 
+# Send heartbeat over the connection to tracker, which answers from memory
+# with the version of membership, and the living hosts only if they change.
+# With several trackers, each of them is sent heartbeats, as they may hold
+# links to paths in this host, and the one holding this host tells members.
 async def heartbeat():
-    header = make_header('ls //', is_heartbeat=True).encode('utf-8')
+    location = '//' + config['ip'] + ':' + config['port']
+    generation = int(time.time() * 1000)
+    versions = {} # membership version known from each tracker
+    while True:
+        await asyncio.sleep(1)
+        logging.debug(f'Send heartbeat')
+        try:
+            shards = (await get_routes())['shards']
+            home = shards[shard_of('//' + config['name'])][1]
+            versions[home] = members_version
+            start = time.perf_counter()
+            results = await asyncio.gather(*[
+                peer_request(addr, f'hb {location} {versions.get(addr, 0)} {generation}', 
+                             is_heartbeat=True) 
+                for _, addr in shards], return_exceptions=True)
+            observe('heartbeat_seconds', time.perf_counter() - start)
+        except OSError as e: # connection lost, reconnect by next heartbeat
+            logging.warning(f'Fail to send heartbeat: {e!r}')
+            continue
+        for (_, addr), result in zip(shards, results):
+            if isinstance(result, Exception):
+                logging.warning(f'Fail to send heartbeat to {addr!r}: {result!r}')
+                continue
+            err_msg, data = result
+            if err_msg.split(' ', 2)[1] != '200': # try again by next heartbeat
+                logging.error(f'Heartbeat to {addr!r} is answered with {err_msg!r}')
+                continue
+            response = json.loads(data)
+            versions[addr] = response['version']
+            if addr == home:
+                update_members(response)
+
+# apply the heartbeat response of the tracker holding this host
+def update_members(response):
+    global members, members_version
+    # get living daemons
+    if response.get('resync'):
+        logging.info('Tracker may have missed changes, resync with it')
+        asyncio.create_task(resync_tree(config['root']))
+    if 'hosts' in response:
+        members = {host['name']: host['addr'] for host in response['hosts']}
+        members_version = response['version']
+        logging.info(f'Living daemons: {list(members)!r}, version {members_version}')
+
+
+# Mark daemons missing heartbeats suspect, and then offline. Paths of an
+# offline daemon are hidden until it comes back, see 'echo_hb'.
+async def listen_heartbeat():
+    global members_version
+    suspect_timeout = config.get('suspect_timeout', SUSPECT_TIMEOUT)
+    offline_timeout = config.get('offline_timeout', OFFLINE_TIMEOUT)
     while True:
         await asyncio.sleep(1)
-        reader, writer = await asyncio.open_connection(
-                config['tracker_ip'], config['tracker_port'])
-        writer.write(header)
-        await writer.drain()
-        logging.info(f'Send heartbeat')
-        if await get_error(reader, writer):
-            return
-        
-        # get living daemons
-        data = await reader.read()
-        response = json.loads(data)
-        daemons = [daemon['name'] for daemon in response]
         now = time.time()
-        logging.info(f'Living daemons: {daemons!r}. time:{now!r}')
+        for name, daemon in daemons.items():
+            if daemon['state'] == 'alive' and now - daemon['seen'] > suspect_timeout:
+                daemon['state'] = 'suspect'
+                members_version += 1
+                logging.info(f'Host {name!r} is suspect')
+            elif daemon['state'] == 'suspect' and now - daemon['seen'] > offline_timeout:
+                daemon['state'] = 'offline'
+                members.pop(name, None)
+                offline_addrs.add(daemon['addr'])
+                members_version += 1
+                logging.info(f'Host {name!r} is offline, hide its paths')
+
+# Hosts in database are suspect when tracker starts, until they send heartbeat.
+async def load_daemons():
+    cursor = await metaDB.cursor()
+    await cursor.execute('''select distinct host_name, host_addr from filesystem
+                    where host_name is not null and host_addr is not null''')
+    now = time.time()
+    trackers = [name for name, _ in routes['shards']] # never go offline
+    for name, addr in await cursor.fetchall():
+        if name not in trackers:
+            daemons[name] = {'seen': now, 'state': 'suspect', 
+                             'generation': None, 'addr': addr}
+            members[name] = addr
+    await cursor.close()
+
+
+#-----------------------------------Watcher-----------------------------------#
+# Watch the paths under root and send their changes to tracker in batches
+# of deltas, like ['a', record] (add), ['m', record] (modify) or 
+# ['d', physical_path] (delete, with everything under it).
+# Changes in 'watch_delay' seconds after the first one are sent together,
+# and a path changed several times in the meantime is sent only once.
+
+IN_MODIFY      = 0x00000002
+IN_ATTRIB      = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM  = 0x00000040
+IN_MOVED_TO    = 0x00000080
+IN_CREATE      = 0x00000100
+IN_DELETE      = 0x00000200
+IN_Q_OVERFLOW  = 0x00004000
+IN_IGNORED     = 0x00008000
+IN_ISDIR       = 0x40000000
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | 
+              IN_MOVED_TO | IN_CREATE | IN_DELETE)
+
+# record of a path in root, see 'make_records'
+def path_record(path, stat):
+    physical = root_to_physical(path, is_dir=False)
+    return [parse_physical_path(physical)[1], None, os.path.isfile(path), 
+            stat.st_ctime, stat.st_mtime, stat.st_size]
+
+async def send_deltas(deltas):
+    for i in range(0, len(deltas), BULK_CHUNK):
+        chunk = deltas[i: i + BULK_CHUNK]
+        if metaDB is not None: # in tracker daemon, rather than its shell
+            await apply_deltas(config['ip'] + ':' + config['port'], 
+                               config['name'], chunk)
+        else:
+            location = '//' + config['ip'] + ':' + config['port']
+            err_msg, _ = await shard_request('//' + config['name'],
+                'up ' + location, content=json.dumps(chunk).encode('utf-8'))
+            check_error(err_msg)
+    logging.info(f'Send {len(deltas)} changes under root to tracker')
+
+class Watcher:
+    def __init__(self, root):
+        self.root = root
+        self.pending = {} # map path to its latest change, 'a', 'm' or 'd'
+        self.timer = None
+        self.tasks = set()
+
+    def mark(self, path, op):
+        if is_partial(path):
+            return
+        if op == 'm' and self.pending.get(path) == 'a':
+            op = 'a'  # still new to tracker
+        self.pending[path] = op
+        if self.timer is None:
+            loop = asyncio.get_running_loop()
+            self.timer = loop.call_later(config.get('watch_delay', 0.5), self.start_flush)
+
+    def start_flush(self):
+        task = asyncio.create_task(self.flush())
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def flush(self):
+        self.timer = None
+        pending, self.pending = self.pending, {}
+        deltas = []
+        for path, op in pending.items():
+            try:
+                stat = os.stat(path)
+            except OSError:  # it's gone, whatever happened before
+                physical = root_to_physical(path, is_dir=False)
+                deltas.append(['d', parse_physical_path(physical)[1]])
+                continue
+            if op == 'd': # deleted, and created again since
+                op = 'm'
+            deltas.append([op, path_record(path, stat)])
+        if deltas:
+            try:
+                await send_deltas(deltas)
+            except ConnectionError as e:
+                logging.warning(f'Fail to send changes: {e!r}')
+
+
+# uses inotify (Linux only)
+class InotifyWatcher(Watcher):
+    def __init__(self, root):
+        super().__init__(root)
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.watches = {} # map watch descriptor to dir path
+
+    def add_watch(self, path):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f'Fail to watch {path!r}')
+        self.watches[wd] = path
+
+    # watch a dir and everything under it, 'mark' them if it's new
+    def add_tree(self, path, is_new=False):
+        self.add_watch(path)
+        for sub_path, is_file, _ in scan_path(path):
+            if not is_file and os.path.isdir(sub_path):
+                self.add_watch(sub_path)
+            if is_new:
+                self.mark(sub_path, 'a')
+
+    def read_events(self):
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = struct.unpack_from('iIII', data, offset)
+            name = os.fsdecode(data[offset + 16: offset + 16 + length].rstrip(b'\0'))
+            offset += 16 + length
+            self.handle_event(wd, mask, name)
+
+    def handle_event(self, wd, mask, name):
+        if mask & IN_Q_OVERFLOW:
+            logging.warning('Too many changes, resync the whole root')
+            self.start_resync()
+            return
+        top = self.watches.get(wd)
+        if top is None:
+            return
+        if mask & IN_IGNORED:  # the dir is gone
+            del self.watches[wd]
+            return
+        if not name:
+            return
+        path = top + '/' + name
+        if mask & (IN_CREATE | IN_MOVED_TO):
+            self.mark(path, 'a')
+            if mask & IN_ISDIR:
+                try:
+                    self.add_tree(path, is_new=True)
+                except OSError as e:
+                    logging.warning(f'{e!r}')
+        elif mask & (IN_DELETE | IN_MOVED_FROM):
+            self.mark(path, 'd')
+        else:
+            self.mark(path, 'm')
+        if mask & (IN_CREATE | IN_MOVED_TO | IN_DELETE | IN_MOVED_FROM):
+            self.mark(top, 'm')  # its mtime changes
+
+    def start_resync(self):
+        if config['istracker']:
+            task = asyncio.create_task(resync_local(self.root))
+        else:
+            task = asyncio.create_task(resync_tree(self.root))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.add_tree, self.root)
+        loop.add_reader(self.fd, self.read_events)
+        logging.info(f'Watching {len(self.watches)} dirs with inotify')
 
 
-async def listen_heartbeat():
-    global daemons
-    while True:
-        await asyncio.sleep(3)
-        host_names = list(daemons.keys()) # make a copy of keys
-        now = time.time()
-        for name in host_names:
-            if now - daemons[name] > 3:
-                del daemons[name]
-                # remove its records in database
-                cursor = await metaDB.cursor()
-                await cursor.execute('delete from filesystem where host_name=?', 
-                                    (name,))
-                await metaDB.commit()
-                await cursor.close()
-                logging.info('Unmount host %s'% name)
+# compares snapshots of mtime and size every 'watch_interval' seconds
+class PollWatcher(Watcher):
+    def snapshot(self):
+        stat = os.stat(self.root)
+        result = {self.root: (False, stat.st_size, stat.st_mtime_ns)}
+        for path, is_file, stat in scan_path(self.root):
+            result[path] = (is_file, stat.st_size, stat.st_mtime_ns)
+        return result
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        snapshot = await loop.run_in_executor(None, self.snapshot)
+        logging.info(f'Watching {len(snapshot)} paths by polling')
+        while True:
+            await asyncio.sleep(config.get('watch_interval', 5))
+            new_snapshot = await loop.run_in_executor(None, self.snapshot)
+            for path, info in new_snapshot.items():
+                if path not in snapshot:
+                    self.mark(path, 'a')
+                elif info != snapshot[path]:
+                    self.mark(path, 'm')
+            for path in snapshot:
+                # only the topmost path of a removed dir is sent
+                if path not in new_snapshot and os.path.split(path)[0] in new_snapshot:
+                    self.mark(path, 'd')
+            snapshot = new_snapshot
+
+
+async def watch_root():
+    mode = config['watch']
+    root = config['root']
+    watcher = None
+    if mode in ('auto', 'inotify') and sys.platform.startswith('linux'):
+        try:
+            watcher = InotifyWatcher(root)
+            await watcher.run()
+            return watcher
+        except OSError as e:
+            logging.warning(f'Fail to use inotify, use polling instead: {e!r}')
+    watcher = PollWatcher(root)
+    task = asyncio.create_task(watcher.run())
+    watcher.tasks.add(task)
+    return watcher
 
 
 async def start_daemon():
     # if we're starting tracker, initiate meta database
     if config['istracker']:
         await init_db()
+        await get_routes()
     await update_db()
 
+    # keep tracker informed of changes under root
+    if config['watch'] != 'off':
+        await watch_root()
+
     # send heartbeat to tracker periodically
     if not config['istracker']:
         asyncio.create_task(heartbeat())
     else:
+        global members_version
+        # start from the clock, so that a restarted tracker doesn't reuse a
+        # version known by daemons
+        members_version = int(time.time() * 1000)
+        for name, addr in routes['shards']:
+            members[name] = addr
+        await load_daemons()
         asyncio.create_task(listen_heartbeat())
     
+    if config.get('metrics_port'):
+        await asyncio.start_server(serve_metrics, '127.0.0.1', config['metrics_port'])
+        logging.info(f'Serving metrics on port {config["metrics_port"]}')
+
+    # other workers pass what they don't serve to this one
+    workers = config.get('workers', WORKERS) if config['istracker'] else 1
+    if workers > 1:
+        path = owner_socket()
+        if os.path.exists(path):
+            os.remove(path)
+        await asyncio.start_unix_server(echo_request, path, limit=STREAM_LIMIT)
+
     server = await asyncio.start_server(
-        echo_request, config['ip'], config['port'])
+        echo_request, config['ip'], config['port'], limit=STREAM_LIMIT, 
+        reuse_port=workers > 1)
     addr = server.sockets[0].getsockname()
     logging.info(f'Serving on {addr}')
     async with server:
@@ -729,10 +3729,134 @@ async def start_daemon():
     if config['istracker']:
         # close database
         global metaDB
+        await close_readers()
         await metaDB.commit()
         await metaDB.close()
 
 
+#---------------------------------Tracker Workers------------------------------#
+# With 'workers' in config, tracker runs so many processes, which all listen
+# on its port by SO_REUSEPORT, so that the kernel spreads connections over
+# them. The first process is the owner: it's the tracker as usual, the only
+# one writing meta database and keeping membership by heartbeats. Others
+# answer 'ls', 'hs', 'rt' and 'ca' by themselves, reading meta database
+# by a reader pool, and pass any other request to the owner over a unix
+# socket: a multiplexed request as a request of their own, and a connection
+# of 'cp' or 'mv' as a whole. 'mt' is passed as well, so that it shows the
+# hosts and heartbeats the owner keeps. Every second they ask the owner for
+# the hosts offline by 'ms', to hide the same paths as the owner does.
+
+WORKER_COMMANDS = ('ls', 'hs', 'rt', 'ca')
+PR_SET_PDEATHSIG = 1
+
+owner_addr = None # path of the owner's socket in a worker, None in others
+
+def owner_socket():
+    return config.get('owner_socket') or \
+           os.path.abspath(config.get('db', 'pns.sqlite3')) + '.sock'
+
+# fork the workers besides the owner, return the index of this process,
+# which is 0 for the owner
+def fork_workers(number):
+    if number > 1 and not sys.platform.startswith('linux'):
+        # workers need fork, prctl and SO_REUSEPORT balancing connections
+        logging.warning('Workers are only supported on Linux, run in one process')
+        config['workers'] = 1 # so 'start_daemon' serves alone
+        return 0
+    for index in range(1, number):
+        if os.fork() == 0:
+            # don't outlive the owner
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            libc.prctl(PR_SET_PDEATHSIG, signal.SIGTERM)
+            return index
+    return 0
+
+async def start_worker(index):
+    global owner_addr, routes
+    owner_addr = owner_socket()
+    routes = make_routes()
+    # wait for the owner to start serving
+    while True:
+        try:
+            err_msg, _ = await peer_request(owner_addr, 'rt')
+            if err_msg.split(' ', 2)[1] == '200':
+                break
+        except OSError:
+            pass
+        await asyncio.sleep(0.1)
+    await open_readers(max(1, config.get('db_readers', DB_READERS)))
+    asyncio.create_task(follow_members())
+
+    server = await asyncio.start_server(
+        echo_request, config['ip'], config['port'], limit=STREAM_LIMIT, 
+        reuse_port=True)
+    logging.info(f'Worker {index} serving on {server.sockets[0].getsockname()}')
+    async with server:
+        await server.serve_forever()
+
+# keep 'offline_addrs' the same as the owner's
+async def follow_members():
+    global members_version
+    while True:
+        await asyncio.sleep(1)
+        try:
+            err_msg, data = await peer_request(owner_addr, ['ms', str(members_version)])
+        except OSError: # eg. the owner's socket is not there yet
+            continue
+        if err_msg.split(' ', 2)[1] != '200':
+            continue
+        response = json.loads(data)
+        if 'offline' in response:
+            offline_addrs.clear()
+            offline_addrs.update(response['offline'])
+        members_version = response['version']
+
+# pass a multiplexed request to the owner, with the fields it came with
+async def forward_request(header, reader, writer):
+    fields = {key: value for key, value in header.items() 
+              if key not in ('A', 'C', 'I', 'L')}
+    content = await reader.read()
+    length = 0 if content else int(header.get('L', 0))
+    try:
+        err_msg, data = await peer_request(owner_addr, header['C'], length, 
+                                           content=content, fields=fields)
+    except ConnectionError:
+        err_msg, data = 'E: 503 Owner Unavailable', b''
+    writer.write(err_msg.encode('utf-8') + b'\n\n' + data)
+    await writer.drain()
+
+# pass the rest of the connection to the owner, starting with 'header'
+async def splice_to_owner(header, reader, writer):
+    try:
+        owner_reader, owner_writer = await asyncio.open_unix_connection(
+            owner_addr, limit=STREAM_LIMIT)
+    except OSError:
+        writer.write(b'E: 503 Owner Unavailable\n\n')
+        await writer.drain()
+        return
+    data = ''.join(f'{key}: {value}\n' for key, value in header.items()) + '\n'
+    owner_writer.write(data.encode('utf-8'))
+
+    async def pipe(src, dst, eof):
+        try:
+            while True:
+                chunk = await src.read(RECV_BUFFER)
+                if not chunk:
+                    break
+                dst.write(chunk)
+                await dst.drain()
+            if eof:
+                dst.write_eof()
+        except ConnectionError:
+            pass
+
+    upstream = asyncio.create_task(pipe(reader, owner_writer, True))
+    await pipe(owner_reader, writer, False)
+    upstream.cancel()
+    owner_writer.close()
+    writer.close()
+
+
 ##############################################################################
 #------------------------------Shell Side------------------------------------#
 
@@ -745,9 +3869,7 @@ def path_in_this_host(path):
         return False
     global config
     location = path.split('/', 3)[2]
-    if config['ip'] == location or config['name'] == location:
-        return True
-    return False
+    return is_this_host(location) or config['ip'] == location
 
 # input path to local path
 def extract_local_path_from(path):
@@ -764,82 +3886,628 @@ async def ln(src, dst):
         logging.warning('src does not exist')
         return
     
-    reader, writer = await asyncio.open_connection(
-                    config['tracker_ip'], config['tracker_port'])
-    cmd = 'ln ' + root_to_physical(src.rstrip('/'), in_default_root=False) + ' ' + dst.rstrip('/')
-    header = make_header(cmd, os.path.getsize(src))
-    logging.debug(f'Send: {header!r}')
-    writer.write(header.encode('utf-8'))
-    await writer.drain()
-    if await get_error(reader, writer):
+    cmd = ['ln', root_to_physical(src.rstrip('/'), in_default_root=False), dst.rstrip('/')]
+    err_msg, _ = await shard_request(dst, cmd, os.path.getsize(src))
+    if check_error(err_msg):
         return
     logging.info('Link ' + src + ' successfully')
-    writer.close()
     
     if os.path.isdir(src):
         await load_path(src.rstrip('/') + '/', logical_root=dst.rstrip('/') + '/', 
                 in_default_root=False, is_tracker=False)
 
 
+# List 'dst' a page after another, see 'echo_ls'. The entries are streamed
+# over a connection of its own, which is resumed from the last page if broken.
+# A path held by every tracker (like '/') is listed from all of them at once,
+# their entries are merged by name, in which each of them lists.
 async def ls(dst):
+    shards = (await get_routes())['shards']
+    index = shard_of(dst)
+    if index is not None:
+        async for items in list_shard(shards[index][1], dst):
+            logging.info(items)
+        return
+    page_size = config.get('ls_page', LS_PAGE)
+    items = []
+    async for item in merge_listings([list_shard(addr, dst) for _, addr in shards]):
+        items.append(item)
+        if len(items) == page_size:
+            logging.info(items)
+            items = []
+    if items:
+        logging.info(items)
+
+# yield the entries of sorted listings in order, those of the same name
+# (like the '/' of each tracker) only once, so only a page of each is kept
+async def merge_listings(listings):
+    async def next_item(index):
+        pages, items = heads[index]
+        item = next(items, None)
+        while item is None:
+            try:
+                items = iter(await pages.__anext__())
+            except StopAsyncIteration:
+                del heads[index]
+                return None
+            item = next(items, None)
+        heads[index] = (pages, items)
+        return item
+
+    heads = {index: (pages, iter(())) for index, pages in enumerate(listings)}
+    items = {}
+    for index in list(heads):
+        item = await next_item(index)
+        if item is not None:
+            items[index] = item
+    last = None
+    while items:
+        index = min(items, key=lambda index: items[index]['name'])
+        item = items.pop(index)
+        if item['name'] != last:
+            yield item
+            last = item['name']
+        item = await next_item(index)
+        if item is not None:
+            items[index] = item
+
+# yield the pages of 'dst' in tracker 'addr'
+async def list_shard(addr, dst):
+    page_size = config.get('ls_page', LS_PAGE)
+    token = None
+    retries = 0
+    ip, port = addr.split(':')
+    while True:
+        fields = {'M': 'ndjson', 'N': page_size}
+        if token:
+            fields['O'] = token
+        writer = None
+        try:
+            reader, writer = await asyncio.open_connection(ip, port)
+            header = make_header(['ls', dst], fields=fields)
+            logging.debug(f'Send: {header!r}')
+            writer.write(header.encode('utf-8'))
+            await writer.drain()
+            if await get_error(reader, writer):
+                return
+            while True:
+                data = await reader.readuntil(b'\n\n')
+                header = parse_header(data.decode('utf-8'))
+                length = int(header['L'])
+                if length == 0:
+                    return
+                content = await reader.readexactly(length)
+                token = header.get('O', token)
+                # get json data
+                yield [json.loads(line) for line in content.splitlines()]
+        except (asyncio.IncompleteReadError, OSError) as e:
+            retries += 1
+            if retries > RANGE_RETRIES:
+                logging.error(f'Give up listing {dst!r}: {e!r}')
+                return
+            logging.warning(f'Connection to tracker is broken, resume listing: {e!r}')
+            await asyncio.sleep(retries)
+        finally:
+            if writer:
+                writer.close()
+
+
+async def md(dst):
+    err_msg, _ = await shard_request(dst, ['md', dst])
+    if check_error(err_msg):
+        return
+    logging.info('Make directory successfully')
+
+
+async def rm(dst):
+    forget(dst)
+    err_msg, _ = await shard_request(dst, ['rm', dst])
+    if check_error(err_msg):
+        return
+    logging.info('Remove successfully')
+
+
+# paths of the files whose content hash is 'file_hash' in host 'addr'
+async def find_copies(file_hash, addr):
+    copies = []
+    for err_msg, data in await fan_out('hs ' + file_hash):
+        if not check_error(err_msg):
+            copies += [item['name'] for item in json.loads(data) if item['host'] == addr]
+    return copies
+
+
+# If the host of 'dst' ('//ip:port/path') already has the content 'file_hash',
+# ask it to make a local copy. Return True if 'dst' has the content then.
+async def copy_existing(file_hash, dst):
+    addr, path = parse_physical_path(dst)
+    copies = await find_copies(file_hash, addr)
+    if path in copies:
+        logging.info(f'{dst!r} is already there')
+        return True
+    for copy in copies:
+        ip, port = addr.split(':')
+        reader, writer = await asyncio.open_connection(ip, port)
+        header = make_header(['cp', '//' + addr + copy, dst], fields={'H': file_hash})
+        logging.debug(f'Send: {header!r}')
+        writer.write(header.encode('utf-8'))
+        await writer.drain()
+        if not await get_error(reader, writer):
+            writer.close()
+            logging.info(f'{dst!r} is copied from {copy!r} in its host')
+            return True
+    return False
+
+
+# copy a file in this host with the content 'file_hash' to local file 'dst', 
+# return False if there isn't one
+async def copy_here(file_hash, dst):
+    copies = await find_copies(file_hash, config['ip'] + ':' + config['port'])
+    for copy in copies:
+        path = config['root'] + copy
+        if os.path.isfile(path) and await copy_local(path, dst, file_hash):
+            logging.info(f'Copy {path!r} to {dst!r} locally')
+            return True
+    return False
+
+
+# copy local file 'src' to 'dst' ('//ip:port/path') in ranges
+async def push_ranges(src, dst, file_hash, progress):
+    addr = parse_physical_path(dst)[0]
+    err_msg, data = await peer_request(addr, ['pt', dst])
+    if check_error(err_msg):
+        return False
+    ranges = ranges_to_copy(json.loads(data), src, os.path.getsize(src), file_hash)
+    codec = await negotiate_codec(addr)
+
+    async def push_range(reader, writer, item):
+        start, end = item
+        await send_range(src, dst, start, end - start, writer, file_hash, codec)
+        if await get_error(reader, writer):
+            return False
+        progress.add(end - start)
+        return True
+
+    return await transfer_items(addr, ranges, push_range)
+
+
+# Copy 'src' ('//ip:port/path') of 'total' bytes to local file 'dst' in ranges.
+# If 'file_hash' is unknown, it's learnt from src host's responses.
+async def pull_ranges(src, dst, total, file_hash=None):
+    addr = parse_physical_path(src)[0]
+    journal = load_journal(dst)
+    if file_hash is None and journal and journal['src'] == src and journal['total'] == total:
+        file_hash = journal.get('hash') # resume with it, src host will confirm it
+    ranges = ranges_to_copy(journal, src, total, file_hash)
+    expected = {'hash': file_hash}
+
+    async def pull_range(reader, writer, item):
+        start, end = item
+        fields = {'R': start}
+        if wanted_codec():
+            fields['Z'] = wanted_codec()
+        header = make_header(['cp', src, dst], end - start, fields=fields)
+        logging.debug(f'Send: {header!r}')
+        writer.write(header.encode('utf-8'))
+        await writer.drain()
+        data = await reader.readuntil(b'\n\n')
+        header = parse_header(data.decode('utf-8'))
+        if 'E' in header:
+            logging.error(header['E'])
+            return False
+        expected['hash'] = expected['hash'] or header.get('H')
+        if int(header['T']) != total or header.get('H') != expected['hash']:
+            logging.error(f'{src!r} has been changed')
+            return False
+        try:
+            await receive_range(dst, src, start, end - start, total, reader, 
+                                expected['hash'], header.get('Z'))
+        except ValueError as e:
+            logging.error(f'{e}')
+            writer.write(b'E: 422 Hash Mismatch\n\n')
+            await writer.drain()
+            return False
+        writer.write(b'E: 200 OK\n\n')
+        await writer.drain()
+        return True
+
+    return await transfer_items(addr, ranges, pull_range)
+
+
+# copy 'src' ('//ip:port/path') to local file 'dst' in one request,
+# src host removes 'src' after that if 'delete_src' is set
+async def pull_whole(src, dst, delete_src):
+    src_sock = parse_physical_path(src)[0].split(':')
+    # send a header to let src host start sending file
     reader, writer = await asyncio.open_connection(
-            config['tracker_ip'], config['tracker_port'])
-    header = make_header('ls ' + dst)
+        src_sock[0], src_sock[1], limit=STREAM_LIMIT)
+    fields = {'Z': wanted_codec()} if wanted_codec() else None
+    if delete_src:
+        header = make_header(['mv', src, dst], fields=fields)
+    else:
+        header = make_header(['cp', src, dst], fields=fields)
     logging.debug(f'Send: {header!r}')
     writer.write(header.encode('utf-8'))
     await writer.drain()
 
-    if await get_error(reader, writer):
-        return
-    
-    # get json data
-    data = await reader.read()
-    response = json.loads(data)
-    logging.info(response)
+    # receive file from src
+    rec_header = await reader.readuntil(b'\n\n')
+    header = parse_header(rec_header.decode('utf-8'))
+    if 'E' in header and header['E'].split(' ', 1)[0] != '200':
+        logging.error(header['E'])
+        writer.close()
+        return False
+    if not 'L' in header:
+        logging.warning('No length field detcted.')
+        writer.close()
+        return False
+    size = int(header['L'])
+    if size < 0:
+        logging.warning('Illegal length field.')
+        writer.close()
+        return False
+    try:
+        received_hash = await receive_file(reader, dst, size, header.get('Z'))
+    except asyncio.IncompleteReadError:
+        logging.error(f'Connection lost while receiving {src!r}')
+        os.remove(dst)
+        return False
+    except ValueError as e:
+        logging.error(f'Fail to receive {src!r}: {e}')
+        os.remove(dst)
+        writer.close()
+        return False
+    if 'H' in header and received_hash != header['H']:
+        logging.error(f'{src!r} is received with a wrong hash')
+        os.remove(dst)
+        writer.write(b'E: 422 Hash Mismatch\n\n')
+        await writer.drain()
+        writer.close()
+        return False
+    writer.write(b'E: 200 OK\n\n')
+    await writer.drain()
     writer.close()
+    return True
 
 
-async def md(dst):
-    reader, writer = await asyncio.open_connection(
-            config['tracker_ip'], config['tracker_port'])
-    header = make_header('md ' + dst)
+# Ask src host to remove 'src' of 'total' bytes, which has been copied to 'dst'.
+# 'total' is None for a dir.
+async def remove_source(src, dst, total):
+    src_sock = parse_physical_path(src)[0].split(':')
+    reader, writer = await asyncio.open_connection(src_sock[0], src_sock[1])
+    fields = {'P': 'end'} if total is None else {'R': total}
+    header = make_header(['mv', src, dst], fields=fields)
     logging.debug(f'Send: {header!r}')
     writer.write(header.encode('utf-8'))
     await writer.drain()
-    
     if await get_error(reader, writer):
-        return
-    logging.info('Make directory successfully')
+        return False
     writer.close()
+    return True
 
 
-async def rm(dst):
-    reader, writer = await asyncio.open_connection(
-            config['tracker_ip'], config['tracker_port'])
-    header = make_header('rm ' + dst)
+# copy local file 'src' to 'dst' ('//ip:port/path'), unless dst host has it
+async def push_one(src, dst, file_hash, progress):
+    size = os.path.getsize(src)
+    if await copy_existing(file_hash, dst):
+        progress.add(size)
+        return True
+    if size > config.get('range_size', RANGE_SIZE):
+        return await push_ranges(src, dst, file_hash, progress)
+    addr = parse_physical_path(dst)[0]
+    codec = await negotiate_codec(addr)
+    ip, port = addr.split(':')
+    reader, writer = await asyncio.open_connection(ip, port)
+    loop = asyncio.get_running_loop()
+    await send_file(src, dst, writer, loop, file_hash, codec)
+    if await get_error(reader, writer):
+        return False
+    writer.close()
+    progress.add(size)
+    return True
+
+
+# copy 'src' ('//ip:port/path') of 'total' bytes to local file 'dst', unless
+# this host has it. src host removes 'src' after that if 'delete_src' is set.
+async def pull_one(src, dst, total, file_hash=None, delete_src=False):
+    if file_hash and await copy_here(file_hash, dst):
+        pass
+    elif total > config.get('range_size', RANGE_SIZE):
+        if not await pull_ranges(src, dst, total):
+            return False
+    else:
+        return await pull_whole(src, dst, delete_src)
+    return not delete_src or await remove_source(src, dst, total)
+
+
+# copy local dir 'src' to 'dst' ('//ip:port/path'), see 'Directory Copy'
+async def push_dir(src, dst, progress):
+    addr = parse_physical_path(dst)[0]
+    err_msg, _ = await peer_request(addr, ['pt', dst])
+    if check_error(err_msg):  # dst exists
+        return False
+    loop = asyncio.get_running_loop()
+    packs, large = await loop.run_in_executor(None, plan_packs, src)
+    progress.total += sum(size for pack in packs + [large] for _, size in pack)
+    codec = await negotiate_codec(addr)
+
+    async def push_pack(reader, writer, pack):
+        data, pack_hash = await loop.run_in_executor(None, make_pack, src, pack)
+        fields = {'P': 'tar', 'H': pack_hash}
+        if codec:
+            fields['Z'] = codec
+        header = make_header(['cp', src, dst], len(data), fields=fields)
+        logging.debug(f'Send: {header!r}')
+        writer.write(header.encode('utf-8'))
+        await send_pack_data(writer, data, codec)
+        if await get_error(reader, writer):
+            return False
+        progress.add(sum(size for _, size in pack))
+        return True
+
+    window = asyncio.Semaphore(config.get('transfer_streams', TRANSFER_STREAMS))
+    async def push_large(name):
+        async with window:
+            path = src + '/' + name
+            return await push_one(path, dst + '/' + name, await hash_file(path), progress)
+
+    # the first pack makes all dirs
+    if not await transfer_items(addr, packs[:1], push_pack):
+        return False
+    results = await asyncio.gather(transfer_items(addr, packs[1:], push_pack),
+                                   *(push_large(name) for name, _ in large))
+    if not all(results):
+        return False
+    logging.info(f'Send {len(packs)} packs and {len(large)} large files')
+    err_msg, _ = await peer_request(addr, ['sc', dst])
+    return not check_error(err_msg)
+
+
+# copy dir 'src' ('//ip:port/path') to local dir 'dst', packs are unpacked
+# while the next ones are being received, see 'Directory Copy'
+async def pull_dir(src, dst):
+    if os.path.exists(dst):
+        logging.warning('dst already exists!')
+        return False
+    ip, port = parse_physical_path(src)[0].split(':')
+    reader, writer = await asyncio.open_connection(ip, port, limit=STREAM_LIMIT)
+    fields = {'P': 'tar'}
+    if wanted_codec():
+        fields['Z'] = wanted_codec()
+    header = make_header(['cp', src, dst], fields=fields)
     logging.debug(f'Send: {header!r}')
     writer.write(header.encode('utf-8'))
     await writer.drain()
-    
-    if await get_error(reader, writer):
+    loop = asyncio.get_running_loop()
+    unpacking = None
+    count = 0
+    try:
+        while True:
+            data = await reader.readuntil(b'\n\n')
+            header = parse_header(data.decode('utf-8'))
+            if 'E' in header:
+                logging.error(header['E'])
+                return False
+            content = await read_data(reader, int(header['L']), header.get('Z'))
+            if unpacking:
+                await unpacking
+            if header['P'] == 'end':
+                large = json.loads(content)
+                break
+            unpacking = loop.run_in_executor(None, extract_pack, content, dst, header['H'])
+            count += 1
+    except (ValueError, tarfile.TarError) as e:
+        logging.error(f'Fail to unpack {src!r}: {e!r}')
+        return False
+    finally:
+        writer.close()
+    logging.info(f'Receive {count} packs of {src!r}')
+
+    window = asyncio.Semaphore(config.get('transfer_streams', TRANSFER_STREAMS))
+    async def pull_large(name, size):
+        async with window:
+            return await pull_one(src + '/' + name, dst + '/' + name, size)
+
+    results = await asyncio.gather(*(pull_large(name, size) for name, size in large))
+    return all(results)
+
+
+# Copy local file or dir 'src' to 'dst' ('//ip:port/path'), and remove 'src'
+# if 'delete_src' is set. Return True if it's done.
+async def push_path(src, dst, delete_src=False, progress=None):
+    progress = progress or Progress()
+    if os.path.isdir(src):
+        src = src.rstrip('/')
+        if not await push_dir(src, dst, progress):
+            return False
+        if delete_src:
+            shutil.rmtree(src)
+    else:
+        # send file to dst, unless dst host has the content
+        file_hash = await hash_file(src)
+        progress.total += os.path.getsize(src)
+        if not await push_one(src, dst, file_hash, progress):
+            return False
+        if delete_src:
+            os.remove(src)
+        elif src.startswith(config['root'] + '/'):
+            await register_file(src)  # let tracker know its hash
+    if delete_src and src.startswith(config['root'] + '/'):
+        await send_deltas([['d', src[len(config['root']):]]])
+    return True
+
+
+# Ask src host of 'src' ('//ip:port/path') to push it to 'dst' in another host,
+# see 'Third-party Copy'. Return True if it's done.
+async def push_between(src, dst, delete_src=False):
+    ip, port = parse_physical_path(src)[0].split(':')
+    reader, writer = await asyncio.open_connection(ip, port)
+    cmd = ['mv' if delete_src else 'cp', src, dst]
+    header = make_header(cmd, fields={'D': 'push'})
+    logging.debug(f'Send: {header!r}')
+    writer.write(header.encode('utf-8'))
+    await writer.drain()
+    try:
+        while True:
+            data = await reader.readuntil(b'\n\n')
+            header = parse_header(data.decode('utf-8'))
+            if 'E' in header:
+                return not check_error('E: ' + header['E'])
+            done, total = map(int, header['S'].split(' '))
+            percent = f' ({done * 100 // total}%)' if total else ''
+            logging.info(f'Copy {done} of {total} bytes{percent}')
+    finally:
+        writer.close()
+
+
+#--------------------------------Resolution Cache------------------------------#
+# 'cp' and 'mv' look up the host and physical path of src and of dst's parent
+# by 'ls'. The shell asks tracker for a lease of 'lease' seconds ('U' field)
+# with each lookup, and keeps the entry until the lease expires, in a file
+# ('resolve_cache' in config) shared by following shells, so scripted copies
+# of many files hardly ask tracker. Entries under a path are dropped when the
+# shell removes, moves or overwrites it, and a copy that fails with cached
+# entries is tried once again with fresh ones.
+
+RESOLVE_CACHE = '~/.pns-resolve.json'
+RESOLVE_ENTRIES = 100000 # max number of entries kept in the file
+
+resolutions = None  # map path to [expire time, entry of 'ls']
+resolutions_changed = False
+# a set of the paths looked up from cache by the current command, 
+# which is its own for each of the commands run at a time
+resolutions_used = contextvars.ContextVar('resolutions_used', default=None)
+
+def resolve_cache_path():
+    path = config.get('resolve_cache', RESOLVE_CACHE)
+    return os.path.expanduser(path) if path else None
+
+def load_resolutions():
+    global resolutions
+    resolutions = {}
+    path = resolve_cache_path()
+    if not path or not os.path.exists(path):
         return
-    logging.info('Remove successfully')
-    writer.close()
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            saved = json.load(f)
+    except (OSError, ValueError) as e:
+        logging.warning(f'Fail to load resolution cache: {e!r}')
+        return
+    if saved.get('tracker') != config['tracker']:
+        return
+    now = time.time()
+    resolutions = {cached: item for cached, item in saved['entries'].items() 
+                   if item[0] > now}
+
+def save_resolutions():
+    path = resolve_cache_path()
+    if not path or not resolutions_changed:
+        return
+    now = time.time()
+    entries = sorted(((cached, item) for cached, item in resolutions.items() 
+                      if item[0] > now), key=lambda entry: entry[1][0])[-RESOLVE_ENTRIES:]
+    try:
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump({'tracker': config['tracker'], 'entries': dict(entries)}, f)
+        os.replace(path + '.tmp', path)
+    except OSError as e:
+        logging.warning(f'Fail to save resolution cache: {e!r}')
+
+# the first entry of 'ls path', ie. the path itself, None if it's not found
+async def lookup(path):
+    global resolutions_changed
+    if resolutions is None:
+        load_resolutions()
+    item = resolutions.get(path)
+    if item and item[0] > time.time():
+        used = resolutions_used.get()
+        if used is not None:
+            used.add(path)
+        return item[1]
+    lease = config.get('lease', LEASE)
+    err_msg, data = await shard_request(path, ['ls', path], 
+                                        fields={'N': 1, 'U': lease} if lease else {'N': 1})
+    if check_error(err_msg):
+        return None
+    response = json.loads(data)
+    if response.get('lease'): # an older tracker doesn't give it
+        resolutions[path] = [time.time() + response['lease'], response['entries'][0]]
+        resolutions_changed = True
+    return response['entries'][0]
+
+# drop cached entries of 'path' and paths under it
+def forget(path):
+    global resolutions_changed
+    if resolutions is None:
+        load_resolutions()
+    path = path.rstrip('/')
+    for cached in [cached for cached in resolutions 
+                   if cached == path or cached.startswith(path + '/')]:
+        del resolutions[cached]
+        resolutions_changed = True
+
+
+# the physical path ('//ip:port/path') of 'src', which is in other host,
+# and what tracker knows about it. Return None if it's not found.
+async def resolve_src(src):
+    record = await lookup(src)
+    if record is None:
+        return None
+    response = [record]
+    src_sock = response[0]['host'].split(':')
+    if src[1] != '/': # src is logical path
+        relative_path = response[0]['type'].lstrip('/')
+    else:
+        relative_path = src.split('/', 3)[3]
+
+    src_path = '//' + ':'.join(src_sock) + '/' + relative_path
+    if src[1] != '/': # see what the logical path points to, if it's in root
+        record = await lookup(src_path)
+        if record is not None:
+            response = [record]
+    return src_path, response[0]
+
 
+# the physical path ('//ip:port/path') of 'dst', which is in other host,
+# None if its parent is not found
+async def resolve_dst(dst):
+    parent = dst[0: dst.rfind('/')]
+    record = await lookup(parent)
+    if record is None:
+        return None
+    response = [record]
+    dst_sock = response[0]['host'].split(':')
+    if dst[1] != '/': # dst is logical path
+        file_name = dst[dst.rfind('/'): ]
+        relative_path = response[0]['type'] + '/' + file_name
+    else:             # dst is physical path
+        relative_path = dst.split('/', 3)[3]
+    return '//' + ':'.join(dst_sock) + '/' + relative_path
 
-# At least one of 'src' and 'dst' should be in this host.
+
+# If neither 'src' nor 'dst' is in this host, src host pushes it to dst host.
 # The one which is in other host is something like '//hostname/path' or '/logical/path'
-async def cp(src, dst, delete_src=False):
+# Return True if it's copied.
+async def copy(src, dst, delete_src=False):
     src_is_here = path_in_this_host(src)
     dst_is_here = path_in_this_host(dst)
     if not src_is_here and not dst_is_here:
-        logging.warning("Either src or dst should be in this host!")
+        resolved = await resolve_src(src)
+        if resolved is None:
+            return False
+        src_path, _ = resolved
+        dst_path = await resolve_dst(dst)
+        if dst_path is None:
+            return False
+        if not await push_between(src_path.rstrip('/'), dst_path.rstrip('/'), delete_src):
+            return False
+        logging.info(f'Copy {src_path!r} to {dst_path!r} successfully!')
     elif src_is_here and dst_is_here: 
         # use local filesystem
         src_path = extract_local_path_from(src)
         if not os.path.exists(src_path):
             logging.warning('src doesn\'t exist!')
-            return
+            return False
         dst_path = extract_local_path_from(dst)
         if delete_src:
             shutil.move(src_path, dst_path)
@@ -850,113 +4518,174 @@ async def cp(src, dst, delete_src=False):
         src_path = extract_local_path_from(src)
         if not os.path.exists(src_path):
             logging.warning('src doesn\'t exist!')
-            return
-                
+            return False
         # try to get dst ip and port
-        reader, writer = await asyncio.open_connection(
-            config['tracker_ip'], config['tracker_port'])
-        parent = dst[0: dst.rfind('/')]
-        header = make_header('ls ' + parent)
-        logging.debug(f'Send: {header!r}')
-        writer.write(header.encode('utf-8'))
-        await writer.drain()
-        if await get_error(reader, writer):
-            return
-        # get response
-        data = await reader.read()
-        response = json.loads(data)
-        dst_sock = response[0]['host'].split(':')
-        if dst[1] != '/': # dst is logical path
-            file_name = dst[dst.rfind('/'): ]
-            relative_path = response[0]['type'] + '/' + file_name
-        else:             # dst is physical path
-            relative_path = dst.split('/', 3)[3]
-        writer.close()
-
-        # send file to dst
-        reader, writer = await asyncio.open_connection(dst_sock[0], dst_sock[1])
-        loop = asyncio.get_running_loop()
-        dst_path = '//' + ':'.join(dst_sock) + '/' + relative_path
-        await send_file(src_path, dst_path, writer, loop)
-        if await get_error(reader, writer):
-            writer.close()
-            return
-        if delete_src:
-            os.remove(src_path)
-            await rm(src)
-        logging.info('Send file successfully!')
-        writer.close()
+        dst_path = await resolve_dst(dst)
+        if dst_path is None:
+            return False
+        if not await push_path(src_path, dst_path, delete_src):
+            return False
+        logging.info('Send successfully!')
 
     else: # dst_is_here
         dst_path = extract_local_path_from(dst)
         # try to get src ip and port
-        reader, writer = await asyncio.open_connection(
-            config['tracker_ip'], config['tracker_port'])
-        header = make_header('ls ' + src)
-        logging.debug(f'Send: {header!r}')
-        writer.write(header.encode('utf-8'))
-        await writer.drain()
-        if await get_error(reader, writer):
-            writer.close()
-            return
-        # get response
-        data = await reader.read()
-        response = json.loads(data)
-        src_sock = response[0]['host'].split(':')
-        if src[1] != '/': # src is logical path
-            relative_path = response[0]['type'].lstrip('/')
-        else:
-            relative_path = src.split('/', 3)[3]
-        writer.close()
-
-        # send a header to let src host start sending file
-        reader, writer = await asyncio.open_connection(src_sock[0], src_sock[1])
-        loop = asyncio.get_running_loop()
-        src_path = '//' + ':'.join(src_sock) + '/' + relative_path
-        if delete_src:
-            header = make_header('mv ' + src_path + ' ' + dst_path)
-        else:
-            header = make_header('cp ' + src_path + ' ' + dst_path)
-        logging.debug(f'Send: {header!r}')
-        writer.write(header.encode('utf-8'))
-        await writer.drain()
+        resolved = await resolve_src(src)
+        if resolved is None:
+            return False
+        src_path, record = resolved
+        if record['type'] == 'd':
+            dst_path = dst_path.rstrip('/')
+            if not await pull_dir(src_path.rstrip('/'), dst_path):
+                return False
+            logging.info(f'Receive dir {src_path!r} successfully')
+            # src host removes the dir only after tracker knows the copy
+            if dst_path.startswith(config['root'] + '/'):
+                await register_tree_again(dst_path)
+            if delete_src and not await remove_source(
+                    src_path, root_to_physical(dst_path, is_dir=False), None):
+                return False
+            return True
 
-        # receive file from src
-        rec_header = await reader.readuntil(b'\n\n')
-        header = parse_header(rec_header.decode('utf-8'))
-        if 'E' in header and header['E'].split(' ', 1)[0] != '200':
-            logging.error(header['E'])
-            writer.close()
-            return
-        if not 'L' in header:
-            logging.warning('No length field detcted.')
-            writer.close()
-            return
-        size = int(header['L'])
-        if size < 0:
-            logging.warning('Illegal length field.')
-            writer.close()
-            return
-        with open(dst_path, 'wb') as f:
-            while size >= 4096:
-                f.write(await reader.read(4096))
-                size -= 4096
-            f.write(await reader.read(size))
-            writer.write(b'E: 200 OK\n\n')
-            await writer.drain()
+        # receive file from src, unless this host has the content
+        total = record['size']
+        file_hash = record.get('hash') # only known for a physical path
+        if not await pull_one(src_path, dst_path, total, file_hash, delete_src):
+            return False
         logging.info(f'Receive file {src_path!r} successfully')
-        writer.close()
 
         # if dst is in root, ln it in tracker's db
-        if dst_path.find(config['root']) != -1:
-            await load_path(dst_path, is_tracker=False)
+        if dst_path.startswith(config['root'] + '/'):
+            await register_file(dst_path)
+    return True
+
+
+# copy again if it fails (or raises) with cached paths, which may be out of date
+async def cp(src, dst, delete_src=False):
+    used = set()
+    token = resolutions_used.set(used)
+    try:
+        try:
+            done = await copy(src, dst, delete_src)
+        except (OSError, asyncio.IncompleteReadError) as e:
+            # eg. a cached host has moved or gone
+            if not used:
+                raise
+            logging.warning(f'Fail to copy with cached paths: {e!r}')
+            done = False
+        if not done and used:
+            logging.info('Copy again without cached paths')
+            for path in used:
+                forget(path)
+            resolutions_used.set(None)
+            done = await copy(src, dst, delete_src)
+    finally:
+        resolutions_used.reset(token)
+    if done:
+        forget(dst)
+        if delete_src:
+            forget(src)
 
 
 async def mv(src, dst):
     await cp(src, dst, delete_src=True)
 
 
+# show metrics of tracker, or of host 'dst' like '//hostname'
+async def mt(dst=None):
+    if dst is None:
+        addr = config['tracker_ip'] + ':' + config['tracker_port']
+    else:
+        addr = dst.strip('/').split('/', 1)[0]
+        if ':' not in addr: # a host name
+            record = await lookup('//' + addr)
+            if record is None:
+                return
+            addr = record['host']
+    err_msg, data = await peer_request(addr, 'mt')
+    if check_error(err_msg):
+        return
+    logging.info(json.dumps(json.loads(data), indent=2))
+
+
 async def do_command(cmd, *args):
+    try:
+        await dispatch_command(cmd, *args)
+    finally:
+        await close_connections()
+        save_resolutions()
+
+
+# Run commands read by 'read_line' (from a file, stdin or a prompt) in one
+# process, so that they share its connections and resolution cache. Up to
+# 'jobs' commands run at a time, started in the order they're read, and a
+# line 'wait' waits for the running ones. Each command reports its time.
+async def run_commands(read_line, jobs=1, interactive=False):
+    window = asyncio.Semaphore(jobs)
+    running = set()
+    count = 0
+    start = time.perf_counter()
+
+    async def run(number, line, args):
+        begin = time.perf_counter()
+        try:
+            await dispatch_command(*args)
+        except Exception as e: # a failed command doesn't stop the others
+            logging.error(f'#{number} {line!r} failed: {e!r}')
+        finally:
+            window.release()
+        logging.info(f'#{number} {line!r} finished in {time.perf_counter() - begin:.3f}s')
+
+    try:
+        while True:
+            line = await read_line()
+            if line is None or line.strip() in ('exit', 'quit'):
+                break
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            if line == 'wait':
+                if running:
+                    await asyncio.wait(running)
+                continue
+            try:
+                args = shlex.split(line)
+            except ValueError as e:
+                logging.error(f'Illegal command {line!r}: {e}')
+                continue
+            await window.acquire()
+            count += 1
+            task = asyncio.create_task(run(count, line, args))
+            running.add(task)
+            task.add_done_callback(running.discard)
+            if interactive:
+                await task
+        if running:
+            await asyncio.wait(running)
+    finally:
+        await close_connections()
+        save_resolutions()
+    elapsed = time.perf_counter() - start
+    logging.info(f'Run {count} commands in {elapsed:.2f}s '
+                 f'({count / max(elapsed, 1e-6):.0f} commands/s)')
+
+# read lines of 'file' in another thread, None at its end
+def file_reader(file):
+    async def read_line():
+        line = await asyncio.get_running_loop().run_in_executor(None, file.readline)
+        return line or None
+    return read_line
+
+def prompt_reader():
+    async def read_line():
+        try:
+            return await asyncio.get_running_loop().run_in_executor(None, input, 'pns> ')
+        except EOFError:
+            return None
+    return read_line
+
+
+async def dispatch_command(cmd, *args):
     if cmd == 'cp':
         await cp(*args)
     elif cmd == 'ln':
@@ -969,6 +4698,8 @@ async def do_command(cmd, *args):
         await mv(*args)
     elif cmd == 'rm':
         await rm(*args)
+    elif cmd == 'mt':
+        await mt(*args)
     else:
         logging.warning('Unknown Command')
 
@@ -981,8 +4712,19 @@ def main():
                         help='mode can be shell or daemon')
     parser.add_argument('-c', '--config', dest='config',
                         help='the config file (*.yml)')
+    parser.add_argument('-z', '--compress', dest='compress', 
+                        choices=list(CODECS) + ['off'],
+                        help='(Available in shell mode) compress copied files by '
+                             'zlib or lzma, if the other host supports it')
+    parser.add_argument('-b', '--batch', dest='batch',
+                        help='(Available in shell mode) run commands in the file, '
+                             'one a line, or from stdin if it\'s \'-\'')
+    parser.add_argument('-j', '--jobs', dest='jobs', type=int,
+                        help='(Available in shell mode) number of commands run '
+                             'at a time in batch mode')
     parser.add_argument('cmd', nargs='*',
-                        help='(Available in shell mode) the command to be executed')
+                        help='(Available in shell mode) the command to be executed, '
+                             'or commands are read from a prompt without it')
 
     args = parser.parse_args()
 
@@ -990,18 +4732,28 @@ def main():
         parse_config(args.config)
     else:
         logging.warning('No config file detected!')
+    if args.compress:
+        config['compress'] = args.compress
 
     if args.mode == 'shell':
-        if not args.cmd:
-            logging.info('Please enter a command')
-        else:
+        jobs = args.jobs or config.get('shell_jobs', SHELL_JOBS)
+        if args.cmd:
             asyncio.run(do_command(*(args.cmd)))
+        elif args.batch and args.batch != '-':
+            with open(args.batch, 'r', encoding='utf-8') as f:
+                asyncio.run(run_commands(file_reader(f), jobs))
+        elif args.batch or not sys.stdin.isatty():
+            asyncio.run(run_commands(file_reader(sys.stdin), jobs))
+        else:
+            asyncio.run(run_commands(prompt_reader(), interactive=True))
     elif args.mode == 'daemon':
         logging.info('Starting daemon...')
         # for Windows, use iocp
         # if sys.platform == 'win32':
         #     asyncio.set_event_loop(asyncio.ProactorEventLoop())\
-        asyncio.run(start_daemon()) 
+        workers = config.get('workers', WORKERS) if config['istracker'] else 1
+        index = fork_workers(workers)
+        asyncio.run(start_worker(index) if index else start_daemon())
     else:
         parser.print_help()
 